@@ -0,0 +1,132 @@
+from __future__ import division
+
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+from benchmark import DTYPES as CONFIGS
+
+
+REFERENCE = 'float64'
+
+
+class Run(object):
+    """
+    An episode of render_video.py built with one of the `CONFIGS` from the same random seed as the others
+    """
+
+    def __init__(self, config, render_args, seed):
+        import render_video
+        from colour_maps import make_colours, needs_ranges
+        from colour_ranges import RangeTracker
+        from video_outputs import VideoOutput
+
+        dtype, reaction_dtype = CONFIGS[config]
+        self.config = config
+        self.args = render_video.parse_args(
+            [os.devnull] + render_args + ['--dtype', dtype, '--reaction-dtype', reaction_dtype]
+        )
+        np.random.seed(seed)
+        self.model, colours, *probes = render_video.episodes[self.args.episode](self.args)
+        self.probes = probes[0] if probes else []
+        if self.args.colours:
+            colours = make_colours(self.args.colours)
+            if needs_ranges(self.args.colours):
+                self.probes.append(RangeTracker('GXY'))
+        shape = (self.args.width, self.args.height)
+        self.convert = render_video.frame_converter(
+            [VideoOutput(os.devnull, colours)], self.model.dims, shape, shape, self.args.upsampling
+        )
+        self.seconds = 0.0
+        self.steps = 0
+
+    def advance(self):
+        """
+        Advance by a video frame and return the fields on the grid and the video frame
+        """
+        start = time.perf_counter()
+        self.model.advance(self.args.oversampling)
+        self.model.t  # Reading the time back waits for the steps to finish
+        self.seconds += time.perf_counter() - start
+        self.steps += self.args.oversampling
+        fields = self.model.fields()
+        grid_fields = {name: field.numpy() for name, field in fields.items()}
+        for probe in self.probes:
+            fields.update(probe.update(fields))
+        return grid_fields, self.convert(fields)[0]
+
+
+def compare(fields, frame, reference_fields, reference_frame):
+    """
+    Errors of `fields` and of the video `frame` against the reference ones
+    """
+    result = {}
+    for name, reference in reference_fields.items():
+        error = fields[name].astype('float64') - reference
+        norm = np.sqrt(np.sum(reference**2))
+        result[name] = {
+            'max_abs_error': float(np.max(np.abs(error))),
+            'relative_l2_error': float(np.sqrt(np.sum(error**2)) / norm) if norm else None,
+        }
+    result['max_pixel_difference'] = int(np.max(np.abs(frame.astype('int32') - reference_frame)))
+    return result
+
+
+def print_report(report):
+    print("Frame {frame} at t = {t:.4g}".format(**report))
+    for config, errors in report['errors'].items():
+        fields = ', '.join(
+            "{} {:.2e} ({:.2e})".format(name, error['max_abs_error'], error['relative_l2_error'] or 0.0)
+            for name, error in errors.items() if name != 'max_pixel_difference'
+        )
+        print("  {:>8}: {}  pixels {}".format(config, fields, errors['max_pixel_difference']))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run an episode in lower precision next to a float64 reference and report how far the fields and '
+                    'the video frames drift apart. The other arguments go to render_video.py.'
+    )
+    parser.add_argument('--configs', choices=[config for config in CONFIGS if config != REFERENCE], nargs='+', default=['float32', 'mixed'])
+    parser.add_argument('--frames', type=int, help='Number of video frames to compare (defaults to the whole video)', metavar='N')
+    parser.add_argument('--report-every', type=int, default=10, help='Report every N video frames', metavar='N')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the episodes')
+    parser.add_argument('--output', type=str, help='Write the reports into this JSON file', metavar='FILE')
+    args, render_args = parser.parse_known_args()
+
+    runs = [Run(config, render_args, args.seed) for config in [REFERENCE] + args.configs]
+    reference = runs[0]
+    num_frames = args.frames or reference.args.num_frames // reference.args.oversampling
+    print("Comparing {} with {} over {} frames of '{}' at {}x{}".format(
+        ', '.join(args.configs), REFERENCE, num_frames, reference.args.episode, reference.args.width, reference.args.height
+    ))
+
+    reports = []
+    for n in range(num_frames):
+        results = [run.advance() for run in runs]
+        if (n + 1) % args.report_every and n + 1 < num_frames:
+            continue
+        report = {
+            'frame': n + 1,
+            't': reference.model.t,
+            'errors': {run.config: compare(*result, *results[0]) for run, result in zip(runs[1:], results[1:])},
+        }
+        reports.append(report)
+        print_report(report)
+
+    speeds = {run.config: run.steps / run.seconds for run in runs}
+    print("Steps per second: {}".format(', '.join(
+        "{} {:.2f} (x{:.2f})".format(config, speed, speed / speeds[REFERENCE]) for config, speed in speeds.items()
+    )))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'settings': vars(args),
+                'render_args': render_args,
+                'steps_per_second': speeds,
+                'reports': reports,
+            }, f, indent=2)
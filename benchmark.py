@@ -0,0 +1,182 @@
+from __future__ import division
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+
+
+MODELS = ['ModelG', 'FluidModelG']
+# Precision of the fields and of the reaction step
+DTYPES = {
+    'float64': ('float64', 'float64'),
+    'float32': ('float32', 'float32'),
+    'mixed': ('float32', 'float64'),
+}
+
+
+def make_model(model, dims, size, dtype='float64', dx=0.5, noise_scale=1e-4):
+    """
+    Model on a periodic `size`^`dims` grid starting from a little noise around the steady state
+    """
+    from model_g import ModelG
+    from fluid_model_g import FluidModelG
+
+    shape = (size,) * dims
+    dtype, reaction_dtype = DTYPES[dtype]
+    G, X, Y = [np.random.randn(*shape) * noise_scale for _ in range(3)]
+    if model == 'ModelG':
+        return ModelG(G, X, Y, dx, dtype=dtype, reaction_dtype=reaction_dtype)
+    flow = [np.random.randn(*shape) * noise_scale for _ in range(dims)]
+    return FluidModelG(G, X, Y, flow, dx, dtype=dtype, reaction_dtype=reaction_dtype)
+
+
+def peak_memory():
+    """
+    Peak resident memory of this process in bytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_case(case, steps, repeats):
+    """
+    Time one benchmark case in a fresh process so that the memory peak belongs to it alone. The first call
+    compiles the integrator and is timed separately. The best of `repeats` runs of `steps` steps counts.
+    """
+    import tensorflow as tf
+
+    baseline = peak_memory()
+    start = time.perf_counter()
+    model = make_model(case['model'], case['dims'], case['size'], case['dtype'])
+    setup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model.advance(1)
+    model.t  # Reading the time back waits for the step to finish
+    compile_time = time.perf_counter() - start
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model.advance(steps)
+        model.t
+        times.append(time.perf_counter() - start)
+    best = min(times)
+
+    points = int(np.prod(model.shape))
+    result = dict(case)
+    result.update(
+        shape=list(model.shape),
+        points=points,
+        steps=steps,
+        threads=tf.config.threading.get_intra_op_parallelism_threads() or os.cpu_count(),
+        setup_seconds=setup,
+        compile_seconds=compile_time,
+        step_seconds=[t / steps for t in times],
+        steps_per_second=steps / best,
+        us_per_point=1e6 * best / (steps * points),
+        peak_memory_bytes=peak_memory(),
+        baseline_memory_bytes=baseline,
+        finite=bool(all(np.isfinite(field.numpy()).all() for field in model.fields().values())),
+    )
+    return result
+
+
+def set_threads(threads):
+    from render_archive import set_threads
+    set_threads(threads)
+
+
+def cases(args):
+    for model in args.models:
+        for dims in args.dims:
+            if model == 'FluidModelG' and dims == 1:
+                continue
+            for size in args.sizes:
+                if size**dims > args.max_points:
+                    continue
+                for dtype in args.dtypes:
+                    yield {'model': model, 'dims': dims, 'size': size, 'dtype': dtype}
+
+
+def machine():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    import tensorflow as tf
+    return {
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'tensorflow': tf.__version__,
+        'devices': [device.name for device in tf.config.list_physical_devices()],
+        'commit': commit,
+    }
+
+
+def case_key(result):
+    return (result['model'], result['dims'], result['size'], result['dtype'], result['threads'])
+
+
+def print_row(result, baseline=None):
+    # Memory is shown above what the process held after starting up TensorFlow
+    line = "{model:>12} {dims}D {size:>5} {dtype:>8} {threads:>3} threads  {steps_per_second:>10.2f} steps/s  {us_per_point:>8.4f} us/point  {memory:>8.1f} MB".format(
+        memory=(result['peak_memory_bytes'] - result['baseline_memory_bytes']) / 2**20, **result
+    )
+    if baseline is not None:
+        line += "  x{:.2f}".format(result['steps_per_second'] / baseline['steps_per_second'])
+    print(line)
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the step throughput of the solvers')
+    parser.add_argument('--models', choices=MODELS, nargs='+', default=MODELS)
+    parser.add_argument('--dims', type=int, choices=[1, 2, 3], nargs='+', default=[1, 2, 3])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 128, 256, 512, 1024], help='Grid points along each axis')
+    parser.add_argument('--max-points', type=int, default=256**3, help='Skip grids with more points than this', metavar='N')
+    parser.add_argument('--dtypes', choices=DTYPES.keys(), nargs='+', default=['float64'], help='mixed runs the reaction step in float64 and everything else in float32')
+    parser.add_argument('--threads', type=int, nargs='+', default=[os.cpu_count()], help='TensorFlow thread counts to try')
+    parser.add_argument('--steps', type=int, default=20, help='Steps per timed run')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed runs per case. The best one counts.')
+    parser.add_argument('--output', type=str, help='Write the results into this JSON file', metavar='FILE')
+    parser.add_argument('--compare', type=str, help='Show the speed-up over the results in this JSON file', metavar='FILE')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = {case_key(result): result for result in json.load(f)['results']}
+
+    # TensorFlow fixes its thread pools on start-up so every thread count (and case) needs a process of its own
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for threads in args.threads:
+        with ProcessPoolExecutor(
+            max_workers=1, mp_context=context, initializer=set_threads, initargs=(threads,), max_tasks_per_child=1
+        ) as executor:
+            for case in cases(args):
+                try:
+                    result = executor.submit(run_case, case, args.steps, args.repeats).result()
+                except Exception as error:
+                    print("{model} {dims}D {size} {dtype} failed: {error}".format(error=error, **case))
+                    continue
+                results.append(result)
+                print_row(result, baseline.get(case_key(result)))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'machine': machine(), 'settings': vars(args), 'results': results}, f, indent=2)
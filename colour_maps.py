@@ -0,0 +1,103 @@
+import tensorflow as tf
+
+
+# The look of the original renders. Each channel maps a field linearly from [min, max] onto [0, gain] (or onto
+# [gain, 0] when inverted) and everything is darkened along the zero contour of the zero line field.
+DEFAULT_COLOURS = {
+    'red': {'field': 'G', 'min': -4.672736908320116, 'max': 0.028719261862332906, 'gain': 6.0, 'invert': True},
+    'green': {'field': 'Y', 'min': -0.7454193158963579, 'max': 4.20524950766914, 'gain': 5.0},
+    'blue': {'field': 'X', 'min': -3.8935243721220334, 'max': 1.2854028081816122, 'gain': 0.7},
+    'zero_line': {'field': 'Y', 'sharpness': 600.0},
+}
+
+
+def merge_colours(config=None):
+    """
+    Fill in whatever `config` leaves out from the default colours. Channels are merged key by key so that a config
+    can for example change just a gain. A `zero_line` of None turns the zero line off.
+    """
+    result = {}
+    config = config or {}
+    for key, default in DEFAULT_COLOURS.items():
+        if key in config and config[key] is None:
+            result[key] = None
+        else:
+            result[key] = dict(default, **config.get(key, {}))
+    return result
+
+
+def auto_colours(config=None):
+    """
+    `config` with the range of every channel set to 'auto'
+    """
+    config = merge_colours(config)
+    for name in ('red', 'green', 'blue'):
+        config[name].update(min='auto', max='auto')
+    return config
+
+
+def colour_fields(config=None):
+    """
+    The fields that the channels of `config` read
+    """
+    return sorted(set(settings['field'] for settings in merge_colours(config).values() if settings is not None))
+
+
+def ranged_fields(config=None):
+    """
+    The fields whose ranges the channels of `config` take from a `colour_ranges.RangeTracker`
+    """
+    return sorted(set(
+        settings['field']
+        for settings in merge_colours(config).values()
+        if settings is not None and 'auto' in (settings.get('min'), settings.get('max'))
+    ))
+
+
+def needs_ranges(config=None):
+    """
+    Whether any channel of `config` takes its range from a `colour_ranges.RangeTracker`
+    """
+    return bool(ranged_fields(config))
+
+
+def field_colours(field, min='auto', max='auto', gain=1.0, invert=False):
+    """
+    Config that shows a single field in greyscale
+    """
+    channel = {'field': field, 'min': min, 'max': max, 'gain': gain, 'invert': invert}
+    return {'red': channel, 'green': dict(channel), 'blue': dict(channel), 'zero_line': None}
+
+
+def make_colours(config=None):
+    """
+    Return a function that maps a dict of fields to [red, green, blue] channels according to `config`
+    (see `DEFAULT_COLOURS`). The fields may carry leading batch axes such as a chunk of archived frames.
+
+    A channel `min` or `max` of 'auto' is read from the `min_<field>`/`max_<field>` entries that a
+    `colour_ranges.RangeTracker` adds to the fields.
+    """
+    config = merge_colours(config)
+
+    def channel(fields, settings):
+        value = fields[settings['field']]
+        low, high = settings['min'], settings['max']
+        if low == 'auto':
+            low = tf.cast(fields['min_' + settings['field']], value.dtype)
+        if high == 'auto':
+            high = tf.cast(fields['max_' + settings['field']], value.dtype)
+        if 'auto' in (settings['min'], settings['max']):
+            # A field that is still flat would otherwise divide by zero
+            high = tf.maximum(high, low + 1e-9)
+        if settings.get('invert'):
+            return settings['gain']*(-value + high) / (high - low)
+        return settings['gain']*(value - low) / (high - low)
+
+    def colours(fields):
+        rgb = [channel(fields, config[name]) for name in ('red', 'green', 'blue')]
+        if config['zero_line'] is None:
+            return rgb
+        zero_line = 1 - tf.exp(-config['zero_line']['sharpness'] * fields[config['zero_line']['field']]**2)
+        return [c * zero_line for c in rgb]
+
+    return colours
@@ -0,0 +1,121 @@
+import numpy as np
+import tensorflow as tf
+from colour_maps import merge_colours
+
+
+class RangeTracker(object):
+    """
+    Running min/max and quantiles of fields kept inside TensorFlow
+
+    The quantiles come from a sketch with logarithmically spaced buckets for either sign (in the spirit of DDSketch)
+    so they are accurate to a relative `accuracy` for magnitudes between `min_magnitude` and `max_magnitude`. Smaller
+    magnitudes count as zero. Updating only touches variables on the device so tracking costs no host syncs.
+    Non-finite values are left out.
+
+    `update` returns the current ranges as tensors named `min_<field>` and `max_<field>`, the lower and upper of
+    `quantiles`. Handed to the colour function along with the fields they drive the 'auto' channel ranges of
+    `colour_maps.make_colours`.
+    """
+
+    def __init__(self, fields=('G', 'X', 'Y'), quantiles=(0.001, 0.999), accuracy=0.01, min_magnitude=1e-9, max_magnitude=1e9):
+        self.fields = list(fields)
+        self.quantiles = quantiles
+        self.min_magnitude = min_magnitude
+
+        self.log_gamma = np.log((1 + accuracy) / (1 - accuracy))
+        self.offset = int(np.floor(np.log(min_magnitude) / self.log_gamma))
+        self.num_buckets = int(np.ceil(np.log(max_magnitude) / self.log_gamma)) - self.offset + 1
+        # Buckets run from the largest negative magnitude through zero up to the largest positive magnitude
+        magnitudes = 2 * np.exp((np.arange(self.num_buckets) + self.offset) * self.log_gamma) / (1 + np.exp(self.log_gamma))
+        self.bucket_values = tf.constant(np.concatenate([-magnitudes[::-1], [0], magnitudes]), 'float64')
+
+        self.minimum = {name: tf.Variable(np.inf, dtype='float64') for name in self.fields}
+        self.maximum = {name: tf.Variable(-np.inf, dtype='float64') for name in self.fields}
+        self.counts = {name: tf.Variable(tf.zeros(self.bucket_values.shape, 'float64')) for name in self.fields}
+        self.update = tf.function(self._update)
+
+    def bucket_index(self, value):
+        magnitude = tf.abs(value)
+        index = tf.cast(tf.math.ceil(tf.math.log(tf.maximum(magnitude, self.min_magnitude)) / self.log_gamma), 'int32')
+        index = tf.clip_by_value(index - self.offset, 0, self.num_buckets - 1)
+        index = tf.where(value > 0, self.num_buckets + 1 + index, self.num_buckets - 1 - index)
+        return tf.where(magnitude < self.min_magnitude, self.num_buckets, index)
+
+    def _update(self, fields):
+        for name in self.fields:
+            value = tf.reshape(tf.cast(fields[name], 'float64'), [-1])
+            finite = tf.math.is_finite(value)
+            value = tf.where(finite, value, 0)
+            self.minimum[name].assign(tf.minimum(self.minimum[name], tf.reduce_min(tf.where(finite, value, np.inf))))
+            self.maximum[name].assign(tf.maximum(self.maximum[name], tf.reduce_max(tf.where(finite, value, -np.inf))))
+            self.counts[name].assign_add(tf.math.bincount(
+                self.bucket_index(value),
+                weights=tf.cast(finite, 'float64'),
+                minlength=self.bucket_values.shape[0],
+                maxlength=self.bucket_values.shape[0],
+                dtype='float64'
+            ))
+        return self._ranges()
+
+    def quantile(self, name, q):
+        cumulative = tf.cumsum(self.counts[name])
+        index = tf.searchsorted(cumulative, [q * cumulative[-1]])[0]
+        value = tf.gather(self.bucket_values, tf.minimum(index, self.bucket_values.shape[0] - 1))
+        return tf.clip_by_value(value, self.minimum[name], self.maximum[name])
+
+    def _ranges(self):
+        low, high = self.quantiles
+        ranges = {}
+        for name in self.fields:
+            ranges['min_' + name] = self.quantile(name, low)
+            ranges['max_' + name] = self.quantile(name, high)
+        return ranges
+
+    def checkpoint_state(self):
+        """
+        Extremes and sketch counts of every field as arrays for a checkpoint
+        """
+        state = {}
+        for name in self.fields:
+            state['min_' + name] = self.minimum[name].numpy()
+            state['max_' + name] = self.maximum[name].numpy()
+            state['counts_' + name] = self.counts[name].numpy()
+        return state
+
+    def restore_state(self, state):
+        """
+        Carry on from the ranges stored by `checkpoint_state`
+        """
+        for name in self.fields:
+            self.minimum[name].assign(state['min_' + name])
+            self.maximum[name].assign(state['max_' + name])
+            self.counts[name].assign(state['counts_' + name])
+
+    def summary(self):
+        """
+        Extremes and quantiles seen so far as plain numbers by field name
+        """
+        low, high = self.quantiles
+        return {
+            name: {
+                'min': float(self.minimum[name].numpy()),
+                'max': float(self.maximum[name].numpy()),
+                'quantile_{}'.format(low): float(self.quantile(name, low).numpy()),
+                'quantile_{}'.format(high): float(self.quantile(name, high).numpy()),
+            }
+            for name in self.fields
+        }
+
+    def colour_config(self, config=None):
+        """
+        Complete colour config with the 'auto' ranges of `config` replaced by the quantiles seen so far
+        """
+        ranges = {name: value.numpy() for name, value in self._ranges().items()}
+        config = merge_colours(config)
+        for settings in config.values():
+            if settings is None:
+                continue
+            for bound in ('min', 'max'):
+                if settings.get(bound) == 'auto':
+                    settings[bound] = float(ranges['{}_{}'.format(bound, settings['field'])])
+        return config
@@ -0,0 +1,77 @@
+import subprocess
+import numpy as np
+import imageio_ffmpeg
+
+
+class FFmpegWriter(object):
+    """
+    Video writer that streams raw rgb24 frames straight into an ffmpeg process
+
+    Takes the same `append_data`/`close` calls as the imageio writers but exposes the encoder settings: `preset`,
+    `crf` (lower is better, 18 is visually lossless for x264), encoder `threads` (0 lets ffmpeg decide) and the
+    output `pixel_format`. With `lossless` the frames are encoded with libx264rgb in RGB so that nothing is lost in
+    a colour space conversion either.
+
+    The ffmpeg process is started on the first frame, which fixes the video size.
+    """
+
+    def __init__(self, filename, fps=24, codec='libx264', preset='medium', crf=18, lossless=False, threads=0, pixel_format=None):
+        self.filename = filename
+        self.fps = fps
+        self.codec = 'libx264rgb' if lossless else codec
+        self.preset = preset
+        self.crf = crf
+        self.lossless = lossless
+        self.threads = threads
+        self.pixel_format = pixel_format or ('rgb24' if lossless else 'yuv420p')
+        self.size = None
+        self.process = None
+
+    def command(self):
+        width, height = self.size
+        command = [
+            imageio_ffmpeg.get_ffmpeg_exe(), '-y', '-v', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '{}x{}'.format(width, height), '-r', str(self.fps), '-i', '-',
+            '-an', '-c:v', self.codec, '-pix_fmt', self.pixel_format, '-preset', self.preset,
+        ]
+        if self.lossless:
+            command += ['-qp', '0']
+        else:
+            command += ['-crf', str(self.crf)]
+        command += ['-threads', str(self.threads), self.filename]
+        return command
+
+    def append_data(self, frame):
+        """
+        Encode a height x width x 3 uint8 RGB frame
+        """
+        frame = np.ascontiguousarray(frame, 'uint8')
+        if frame.ndim != 3 or frame.shape[2] != 3:
+            raise ValueError("Expected an RGB frame, got shape {}".format(frame.shape))
+        height, width = frame.shape[:2]
+        if self.process is None:
+            self.size = (width, height)
+            self.process = subprocess.Popen(self.command(), stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        elif self.size != (width, height):
+            raise ValueError("Frame size {}x{} differs from the video size {}x{}".format(width, height, *self.size))
+
+        try:
+            self.process.stdin.write(frame.data)
+        except BrokenPipeError:
+            self.close()
+
+    def close(self):
+        """
+        Finish encoding and wait for ffmpeg to exit
+        """
+        if self.process is None:
+            return
+        process, self.process = self.process, None
+        if not process.stdin.closed:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+        error = process.stderr.read().decode(errors='replace')
+        if process.wait() != 0:
+            raise RuntimeError("ffmpeg failed writing {}: {}".format(self.filename, error.strip()))
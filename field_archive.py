@@ -0,0 +1,141 @@
+import glob
+import json
+import os
+import queue
+import threading
+import numpy as np
+
+
+class FieldArchiveWriter(object):
+    """
+    Records simulation fields frame by frame into a directory of compressed chunks from a background thread
+
+    Each chunk `chunk_NNNNNNNN.npz` holds `frames_per_chunk` consecutive frames (numbered from the first one in it)
+    as one array per field plus their times `t`. The fields are stored as `dtype` to keep the archive small.
+    `metadata` goes into `archive.json` next to the chunks.
+
+    Like `snapshots.SnapshotWriter` submitting only queues references to the field tensors and the queue is bounded.
+    Writing starts at `start_frame` and any chunks from an earlier run at or past it are removed, so a resumed render
+    carries on where its last checkpoint left off (call `flush` when checkpointing).
+    """
+
+    def __init__(self, path, fields=('G', 'X', 'Y'), frames_per_chunk=32, dtype='float32', compress=True, start_frame=0, metadata=None, max_pending=4):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.fields = list(fields)
+        self.frames_per_chunk = frames_per_chunk
+        self.dtype = dtype
+        self.compress = compress
+        self.frame = start_frame
+
+        for filename in glob.glob(os.path.join(path, 'chunk_*.npz')):
+            if chunk_start(filename) >= start_frame:
+                os.remove(filename)
+        with open(os.path.join(path, 'archive.json'), 'w') as f:
+            json.dump(dict(metadata or {}, fields=self.fields), f, indent=4)
+
+        self.times = []
+        self.frames = []
+        self.chunk = start_frame
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, t, fields):
+        """
+        Queue the next frame with the fields (a dict of tensors or arrays) at time `t`. Fields not archived are ignored.
+        """
+        self._check()
+        self.queue.put((t, {name: fields[name] for name in self.fields}))
+
+    def flush(self):
+        """
+        Write out all submitted frames including a partial chunk and wait for them to be on disk
+        """
+        self.queue.put('flush')
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+    def _check(self):
+        if self.error is not None:
+            raise RuntimeError("Writing to the field archive failed") from self.error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is not None:
+                    continue
+                if item == 'flush':
+                    self._write_chunk()
+                else:
+                    t, fields = item
+                    self.times.append(t)
+                    self.frames.append({name: np.asarray(field, self.dtype) for name, field in fields.items()})
+                    if len(self.frames) >= self.frames_per_chunk:
+                        self._write_chunk()
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def _write_chunk(self):
+        if not self.frames:
+            return
+        arrays = {name: np.stack([frame[name] for frame in self.frames]) for name in self.fields}
+        filename = os.path.join(self.path, 'chunk_{:08d}.npz'.format(self.chunk))
+        temporary = '{}.tmp'.format(filename)
+        save = np.savez_compressed if self.compress else np.savez
+        with open(temporary, 'wb') as f:
+            save(f, t=np.array(self.times), **arrays)
+        os.replace(temporary, filename)
+
+        self.chunk += len(self.frames)
+        self.times = []
+        self.frames = []
+
+
+class FieldArchive(object):
+    """
+    Read access to an archive written by `FieldArchiveWriter`
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'archive.json')) as f:
+            self.metadata = json.load(f)
+        self.fields = self.metadata['fields']
+        self.chunks = sorted(glob.glob(os.path.join(path, 'chunk_*.npz')), key=chunk_start)
+        if not self.chunks:
+            raise ValueError("No frames archived in {}".format(path))
+
+    def __len__(self):
+        return chunk_start(self.chunks[-1]) + len(self.load_chunk(self.chunks[-1])['t'])
+
+    def load_chunk(self, filename):
+        """
+        Times and fields of the frames in a chunk file as a dict of arrays with the frame index in front
+        """
+        with np.load(filename) as data:
+            return {key: data[key] for key in data.files}
+
+    def __iter__(self):
+        """
+        Iterate over the frames as (t, fields) pairs
+        """
+        for filename in self.chunks:
+            chunk = self.load_chunk(filename)
+            for i, t in enumerate(chunk['t']):
+                yield t, {name: chunk[name][i] for name in self.fields}
+
+
+def chunk_start(filename):
+    return int(os.path.basename(filename)[len('chunk_'):-len('.npz')])
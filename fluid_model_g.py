@@ -3,6 +3,7 @@ import tensorflow as tf
 import numpy as np
 import util
 from pde_solver import PDESolverDx
+from sources import Source
 from integrators.model_g import polynomial_order_4_centered as reaction_integrator
 from integrators.model_g import steady_state
 
@@ -29,72 +30,76 @@ DEFAULT_PARAMS = {
 class FluidModelG(PDESolverDx):
     """
     Model G on a fluid medium
+
+    With `batched` the concentrations and flow components have a leading ensemble axis and every parameter may be
+    given either as a single value or as one value per member.
+
+    The fields and flow are kept in `dtype`. The stiff reaction polynomial can run at a higher `reaction_dtype` (say
+    float64 for float32 fields).
+
+    With `real_fft` (the default) the transforms only keep half of the spectrum. The viscous shear kernels are made
+    Hermitian for it (see `decay_gradient`) so the results match the full complex transform up to round-off.
     """
-    def __init__(self, concentration_G, concentration_X, concentration_Y, u, dx, dt=None, params=None, source_functions=None):
+    def __init__(self, concentration_G, concentration_X, concentration_Y, u, dx, dt=None, params=None, source_functions=None, real_fft=True, batched=False, dtype='float64', reaction_dtype=None):
         if dt is None:
             dt = 0.1 * dx
 
         if dt > 0.5 * dx:
             warnings.warn("Time increment {} too large for simulation stability with grid constant {}".format(dt, dx))
 
-        super().__init__(dx, dt, concentration_G.shape)
+        if batched:
+            super().__init__(dx, dt, concentration_G.shape[1:], real_fft=real_fft, batch_size=concentration_G.shape[0], dtype=dtype)
+        else:
+            super().__init__(dx, dt, concentration_G.shape, real_fft=real_fft, dtype=dtype)
+        self.reaction_dtype = tf.as_dtype(reaction_dtype or dtype)
 
         self.params = params or DEFAULT_PARAMS
         self.source_functions = source_functions or {}
 
-        self.G = tf.constant(concentration_G, 'float64')
-        self.X = tf.constant(concentration_X, 'float64')
-        self.Y = tf.constant(concentration_Y, 'float64')
+        if concentration_X.shape != concentration_Y.shape or concentration_X.shape != concentration_G.shape:
+            raise ValueError("Concentration shapes must match")
 
-        G0, X0, Y0 = steady_state(self.params['A'], self.params['B'], self.params['k2'], self.params['k-2'], self.params['k5'])
+        # G, X and Y are kept stacked so that the spectral stages transform all of them in one batched call
+        self.concentrations = tf.constant(np.array([concentration_G, concentration_X, concentration_Y]), self.dtype)
 
+        if self.dims not in (2, 3):
+            raise ValueError('Only 2D and 3D supported')
         if len(u) != self.dims:
             raise ValueError("{0}-dimensional flow must have {0} components".format(self.dims))
+        self.flow = [tf.constant(component, self.dtype) for component in u]
+
+        self.build()
 
-        c2 = self.params["speed-of-sound"]**2
-        viscosity = self.params["viscosity"]
-        if self.dims == 1:
-            raise ValueError("1D not supported")
-        elif self.dims == 2:
-            self.u = tf.constant(u[0], 'float64')
-            self.v = tf.constant(u[1], 'float64')
-
-            omega_x, omega_y = self.omega_x, self.omega_y
-            omega2 = omega_x**2 + omega_y**2
-            omega2_x = tf.constant(omega2 + 1/3 * omega_x * (omega_x + omega_y), "complex128")
-            omega2_y = tf.constant(omega2 + 1/3 * omega_y * (omega_x + omega_y), "complex128")
-            decay_x = tf.exp(-viscosity * omega2_x * self.dt)
-            decay_y = tf.exp(-viscosity * omega2_y * self.dt)
-
-            delta = tf.constant(-omega2 * self.dt, "complex128")
-            decay_G = tf.exp(self.params['D_G'] * delta)
-            decay_X = tf.exp(self.params['D_X'] * delta)
-            decay_Y = tf.exp(self.params['D_Y'] * delta)
+    def build(self):
+        param = lambda key, default=None: self.batch_param(self.params.get(key, default))
+        A, B, k2, k_2, k5 = param('A'), param('B'), param('k2'), param('k-2'), param('k5')
+        G0, X0, Y0 = steady_state(A, B, k2, k_2, k5)
+
+        c2 = param("speed-of-sound")**2
+        viscosity = param("viscosity")
+        D = [param('D_G'), param('D_X'), param('D_Y')]
+        diffusivity = tf.constant(np.reshape(np.stack(D), [3] + self.batch_shape + [1] * self.dims), self.dtype)
+        # The decay kernels are made from the per-axis omegas inside the graph. See `decay`.
+        omega = self.wave_numbers()
+        if self.dims == 2:
+            omega_x, omega_y = omega
+            # Viscosity and internal shear. See `decay_gradient` for the cross terms.
+            shear_x = lambda omega_x, omega_y: viscosity * (omega_x**2 + omega_y**2 + 1/3 * omega_x * (omega_x + omega_y))
+            shear_y = lambda omega_x, omega_y: viscosity * (omega_x**2 + omega_y**2 + 1/3 * omega_y * (omega_x + omega_y))
 
             def flow_integrator(rho, u, v):
                 """
                 Flow is integrated with respect to the total log density (rho)
                 """
                 # Enter Fourier Domain
-                f_rho = self.fft(tf.cast(rho, 'complex128'))
-                waves_x = self.fft(tf.cast(u, 'complex128'))
-                waves_y = self.fft(tf.cast(v, 'complex128'))
-
-                # Viscosity and internal shear
-                waves_x *= decay_x
-                waves_y *= decay_y
-
-                # Exit Fourier Domain
-                u = tf.cast(self.ifft(waves_x), 'float64')
-                v = tf.cast(self.ifft(waves_y), 'float64')
-
-                # Calculate gradients
-                rho_dx = tf.cast(self.ifft(f_rho * self.kernel_dx), 'float64')
-                rho_dy = tf.cast(self.ifft(f_rho * self.kernel_dy), 'float64')
-                u_dx = tf.cast(self.ifft(waves_x * self.kernel_dx), 'float64')
-                u_dy = tf.cast(self.ifft(waves_x * self.kernel_dy), 'float64')
-                v_dx = tf.cast(self.ifft(waves_y * self.kernel_dx), 'float64')
-                v_dy = tf.cast(self.ifft(waves_y * self.kernel_dy), 'float64')
+                f_rho = self.fft(rho)
+                waves_x = self.fft(u)
+                waves_y = self.fft(v)
+
+                # Viscosity and internal shear, exit Fourier Domain and calculate gradients
+                u, u_dx, u_dy = tf.unstack(self.decay_gradient(waves_x, shear_x))
+                v, v_dx, v_dy = tf.unstack(self.decay_gradient(waves_y, shear_y))
+                rho_dx, rho_dy = tf.unstack(self.gradient(f_rho))
                 divergence = u_dx + v_dy
 
                 # This would handle log density continuity but it's actually handled individually for G, X and Y
@@ -117,133 +122,38 @@ class FluidModelG(PDESolverDx):
 
                 return u, v, divergence
 
-            def diffusion_advection_integrator1(G, u, v, divergence): # BJD added 25.6.2021
-                f_G = self.fft(tf.cast(G, 'complex128'))
-                #f_X = self.fft(tf.cast(X, 'complex128'))
-                #f_Y = self.fft(tf.cast(Y, 'complex128'))
-
-                f_G *= decay_G
-                #f_X *= decay_X
-                #f_Y *= decay_Y
-
-                G = tf.cast(self.ifft(f_G), 'float64')
-                #X = tf.cast(self.ifft(f_X), 'float64')
-                #Y = tf.cast(self.ifft(f_Y), 'float64')
-
-                G_dx = tf.cast(self.ifft(f_G * self.kernel_dx), 'float64')
-                G_dy = tf.cast(self.ifft(f_G * self.kernel_dy), 'float64')
-                #X_dx = tf.cast(self.ifft(f_X * self.kernel_dx), 'float64')
-                #X_dy = tf.cast(self.ifft(f_X * self.kernel_dy), 'float64')
-                #Y_dx = tf.cast(self.ifft(f_Y * self.kernel_dx), 'float64')
-                #Y_dy = tf.cast(self.ifft(f_Y * self.kernel_dy), 'float64')
-
-                G -= (u*G_dx + v*G_dy + G*divergence) * self.dt
-                #X -= (u*X_dx + v*X_dy + X*divergence) * self.dt
-                #Y -= (u*Y_dx + v*Y_dy + Y*divergence) * self.dt
-                return G #, X, Y
-
-            def diffusion_advection_integrator2(X, u, v, divergence): # BJD added 25.6.2021
-                #f_G = self.fft(tf.cast(G, 'complex128'))
-                f_X = self.fft(tf.cast(X, 'complex128'))
-                #f_Y = self.fft(tf.cast(Y, 'complex128'))
-
-                #f_G *= decay_G
-                f_X *= decay_X
-                #f_Y *= decay_Y
-
-                #G = tf.cast(self.ifft(f_G), 'float64')
-                X = tf.cast(self.ifft(f_X), 'float64')
-                #Y = tf.cast(self.ifft(f_Y), 'float64')
-
-                #G_dx = tf.cast(self.ifft(f_G * self.kernel_dx), 'float64')
-                #G_dy = tf.cast(self.ifft(f_G * self.kernel_dy), 'float64')
-                X_dx = tf.cast(self.ifft(f_X * self.kernel_dx), 'float64')
-                X_dy = tf.cast(self.ifft(f_X * self.kernel_dy), 'float64')
-                #Y_dx = tf.cast(self.ifft(f_Y * self.kernel_dx), 'float64')
-                #Y_dy = tf.cast(self.ifft(f_Y * self.kernel_dy), 'float64')
-
-                #G -= (u*G_dx + v*G_dy + G*divergence) * self.dt
-                X -= (u*X_dx + v*X_dy + X*divergence) * self.dt
-                #Y -= (u*Y_dx + v*Y_dy + Y*divergence) * self.dt
-                return X #G, X, Y
-
-            def diffusion_advection_integrator3(Y, u, v, divergence): # BJD added 25.6.2021
-                #f_G = self.fft(tf.cast(G, 'complex128'))
-                #f_X = self.fft(tf.cast(X, 'complex128'))
-                f_Y = self.fft(tf.cast(Y, 'complex128'))
-
-                #f_G *= decay_G
-                #f_X *= decay_X
-                f_Y *= decay_Y
-
-                #G = tf.cast(self.ifft(f_G), 'float64')
-                #X = tf.cast(self.ifft(f_X), 'float64')
-                Y = tf.cast(self.ifft(f_Y), 'float64')
-
-                #G_dx = tf.cast(self.ifft(f_G * self.kernel_dx), 'float64')
-                #G_dy = tf.cast(self.ifft(f_G * self.kernel_dy), 'float64')
-                #X_dx = tf.cast(self.ifft(f_X * self.kernel_dx), 'float64')
-                #X_dy = tf.cast(self.ifft(f_X * self.kernel_dy), 'float64')
-                Y_dx = tf.cast(self.ifft(f_Y * self.kernel_dx), 'float64')
-                Y_dy = tf.cast(self.ifft(f_Y * self.kernel_dy), 'float64')
-
-                #G -= (u*G_dx + v*G_dy + G*divergence) * self.dt
-                #X -= (u*X_dx + v*X_dy + X*divergence) * self.dt
-                Y -= (u*Y_dx + v*Y_dy + Y*divergence) * self.dt
-                return Y #G, X, Y
+            def diffusion_advection_integrator(concentrations, u, v, divergence):
+                """
+                Diffuse and advect the stacked species. The divergence is either shared or stacked per species.
+                """
+                f = self.fft(concentrations)
+                f *= self.decay(diffusivity * (omega_x**2 + omega_y**2))
+
+                concentrations = tf.cast(self.ifft(f), self.dtype)
+                concentrations_dx, concentrations_dy = tf.unstack(self.gradient(f))
+
+                concentrations -= (u*concentrations_dx + v*concentrations_dy + concentrations*divergence) * self.dt
+                return concentrations
 
         elif self.dims == 3:
-            self.u = tf.constant(u[0], 'float64')
-            self.v = tf.constant(u[1], 'float64')
-            self.w = tf.constant(u[2], 'float64')
-
-            omega_x, omega_y, omega_z = self.omega_x, self.omega_y, self.omega_z
-            omega2 = omega_x**2 + omega_y**2 + omega_z**2
-            omega2_x = tf.constant(omega2 + 1/3 * omega_x * (omega_x + omega_y + omega_z), "complex128")
-            omega2_y = tf.constant(omega2 + 1/3 * omega_y * (omega_x + omega_y + omega_z), "complex128")
-            omega2_z = tf.constant(omega2 + 1/3 * omega_z * (omega_x + omega_y + omega_z), "complex128")
-            decay_x = tf.exp(-viscosity * omega2_x * self.dt)
-            decay_y = tf.exp(-viscosity * omega2_y * self.dt)
-            decay_z = tf.exp(-viscosity * omega2_z * self.dt)
-
-            delta = tf.constant(-omega2 * self.dt, "complex128")
-            decay_G = tf.exp(self.params['D_G'] * delta)
-            decay_X = tf.exp(self.params['D_X'] * delta)
-            decay_Y = tf.exp(self.params['D_Y'] * delta)
+            omega_x, omega_y, omega_z = omega
+            # Viscosity and internal shear. See `decay_gradient` for the cross terms.
+            def shear(i):
+                return lambda *omega: viscosity * (sum(o**2 for o in omega) + 1/3 * omega[i] * sum(omega))
+            steady = tf.constant(np.reshape(np.stack([G0, X0, Y0]), [3] + self.batch_shape + [1] * self.dims), self.dtype)
 
             def flow_integrator(rho, u, v, w):
                 # Enter Fourier Domain
-                f_rho = self.fft(tf.cast(rho, 'complex128'))
-                waves_x = self.fft(tf.cast(u, 'complex128'))
-                waves_y = self.fft(tf.cast(v, 'complex128'))
-                waves_z = self.fft(tf.cast(w, 'complex128'))
-
-                # Viscosity and internal shear
-                waves_x *= decay_x
-                waves_y *= decay_y
-                waves_z *= decay_z
-
-                # Exit Fourier Domain
-                u = tf.cast(self.ifft(waves_x), 'float64')
-                v = tf.cast(self.ifft(waves_y), 'float64')
-                w = tf.cast(self.ifft(waves_z), 'float64')
-
-                # Calculate gradients
-                rho_dx = tf.cast(self.ifft(f_rho * self.kernel_dx), 'float64')
-                rho_dy = tf.cast(self.ifft(f_rho * self.kernel_dy), 'float64')
-                rho_dz = tf.cast(self.ifft(f_rho * self.kernel_dz), 'float64')
-
-                u_dx = tf.cast(self.ifft(waves_x * self.kernel_dx), 'float64')
-                u_dy = tf.cast(self.ifft(waves_x * self.kernel_dy), 'float64')
-                u_dz = tf.cast(self.ifft(waves_x * self.kernel_dz), 'float64')
-
-                v_dx = tf.cast(self.ifft(waves_y * self.kernel_dx), 'float64')
-                v_dy = tf.cast(self.ifft(waves_y * self.kernel_dy), 'float64')
-                v_dz = tf.cast(self.ifft(waves_y * self.kernel_dz), 'float64')
-
-                w_dx = tf.cast(self.ifft(waves_z * self.kernel_dx), 'float64')
-                w_dy = tf.cast(self.ifft(waves_z * self.kernel_dy), 'float64')
-                w_dz = tf.cast(self.ifft(waves_z * self.kernel_dz), 'float64')
+                f_rho = self.fft(rho)
+                waves_x = self.fft(u)
+                waves_y = self.fft(v)
+                waves_z = self.fft(w)
+
+                # Viscosity and internal shear, exit Fourier Domain and calculate gradients
+                u, u_dx, u_dy, u_dz = tf.unstack(self.decay_gradient(waves_x, shear(0)))
+                v, v_dx, v_dy, v_dz = tf.unstack(self.decay_gradient(waves_y, shear(1)))
+                w, w_dx, w_dy, w_dz = tf.unstack(self.decay_gradient(waves_z, shear(2)))
+                rho_dx, rho_dy, rho_dz = tf.unstack(self.gradient(f_rho))
 
                 divergence = u_dx + v_dy + w_dz
 
@@ -270,85 +180,144 @@ class FluidModelG(PDESolverDx):
                 w += dw * self.dt
 
                 return u, v, w, divergence
-            def diffusion_advection_integrator(G, X, Y, u, v, w, divergence):
-                f_G = self.fft(tf.cast(G, 'complex128'))
-                f_X = self.fft(tf.cast(X, 'complex128'))
-                f_Y = self.fft(tf.cast(Y, 'complex128'))
-
-                f_G *= decay_G
-                f_X *= decay_X
-                f_Y *= decay_Y
-
-                G = tf.cast(self.ifft(f_G), 'float64')
-                X = tf.cast(self.ifft(f_X), 'float64')
-                Y = tf.cast(self.ifft(f_Y), 'float64')
-
-                G_dx = tf.cast(self.ifft(f_G * self.kernel_dx), 'float64')
-                G_dy = tf.cast(self.ifft(f_G * self.kernel_dy), 'float64')
-                G_dz = tf.cast(self.ifft(f_G * self.kernel_dz), 'float64')
-                X_dx = tf.cast(self.ifft(f_X * self.kernel_dx), 'float64')
-                X_dy = tf.cast(self.ifft(f_X * self.kernel_dy), 'float64')
-                X_dz = tf.cast(self.ifft(f_X * self.kernel_dz), 'float64')
-                Y_dx = tf.cast(self.ifft(f_Y * self.kernel_dx), 'float64')
-                Y_dy = tf.cast(self.ifft(f_Y * self.kernel_dy), 'float64')
-                Y_dz = tf.cast(self.ifft(f_Y * self.kernel_dz), 'float64')
-
-                G -= (u*G_dx + v*G_dy + w*G_dz + (G+G0)*divergence) * self.dt
-                X -= (u*X_dx + v*X_dy + w*X_dz + (X+X0)*divergence) * self.dt
-                Y -= (u*Y_dx + v*Y_dy + w*Y_dz + (Y+Y0)*divergence) * self.dt
-                return G, X, Y
-        else:
-            raise ValueError('Only up to 3D supported')
-
-        reaction_integrator_curried = lambda con_G, con_X, con_Y: reaction_integrator(
-            con_G, con_X, con_Y,
-            self.dt, self.params['A'], self.params['B'], self.params['k2'], self.params['k-2'], self.params['k5']
-        )
-
+            def diffusion_advection_integrator(concentrations, u, v, w, divergence):
+                f = self.fft(concentrations)
+                f *= self.decay(diffusivity * (omega_x**2 + omega_y**2 + omega_z**2))
+
+                concentrations = tf.cast(self.ifft(f), self.dtype)
+                concentrations_dx, concentrations_dy, concentrations_dz = tf.unstack(self.gradient(f))
+
+                concentrations -= (
+                    u*concentrations_dx + v*concentrations_dy + w*concentrations_dz + (concentrations + steady)*divergence
+                ) * self.dt
+                return concentrations
+
+        def reaction_integrator_curried(con_G, con_X, con_Y):
+            result = reaction_integrator(
+                *[tf.cast(c, self.reaction_dtype) for c in (con_G, con_X, con_Y)],
+                self.dt, A, B, k2, k_2, k5
+            )
+            return tuple(tf.cast(c, self.dtype) for c in result)
+
+        # Source terms that would change the concentrations by less than this in a time step are skipped
+        source_tolerance = self.params.get('source-tolerance', 1e-12)
+
+        def source_integrator(t, G, X, Y):
+            """
+            Sources are evaluated inside the step graph. See `sources.Source` or write them with TensorFlow ops on `t`
+            """
+            result = []
+            for name, concentration in zip('GXY', (G, X, Y)):
+                source = self.source_functions.get(name)
+                if isinstance(source, Source):
+                    concentration = source.apply(t, concentration, self.dt, source_tolerance)
+                elif source is not None:
+                    concentration += self.dt * tf.cast(source(t), concentration.dtype)
+                result.append(concentration)
+            return result
+
+        # In 2D the flow is by default updated once per species using its own log density offset.
+        # With "shared-flow" a single update against "base-density" is shared by all three species.
+        shared_flow = self.params.get('shared-flow', False)
+        base_density = param('base-density')
+        base_density_G = param('base-density1', 35.0)
+        base_density_X = param('base-density2', 36.0)
+        base_density_Y = param('base-density3', 37.0)
+        density_G, density_X, density_Y = param('density_G'), param('density_X'), param('density_Y')
+
+        def step(t, state):
+            concentrations, flow = state
+            G, X, Y = self.phase('reaction_integrator', reaction_integrator_curried, *tf.unstack(concentrations))
+            concentrations = tf.stack([G, X, Y])
+            density_of_reactants = density_G * G + density_X * X + density_Y * Y
+
+            if self.dims == 2 and shared_flow:
+                u, v = flow  # Store unintegrated flow so that we're on the same timestep
+                rho = tf.math.log(base_density + density_of_reactants)
+
+                flow_u, flow_v, divergence = self.phase('flow_integrator', flow_integrator, rho, u, v)
+                concentrations = self.phase(
+                    'diffusion_advection_integrator', diffusion_advection_integrator, concentrations, u, v, divergence
+                )
+
+                flow = (flow_u, flow_v)
+            elif self.dims == 2:
+                u, v = flow  # Store unintegrated flow so that we're on the same timestep
+                flow_u, flow_v = u, v
+
+                # The flow is updated in turn for G, X and Y but each species is advected by its own divergence
+                divergences = []
+                for species_base_density in (base_density_G, base_density_X, base_density_Y):
+                    rho = tf.math.log(species_base_density + density_of_reactants)
+                    flow_u, flow_v, divergence = self.phase('flow_integrator', flow_integrator, rho, flow_u, flow_v)
+                    divergences.append(divergence)
+                concentrations = self.phase(
+                    'diffusion_advection_integrator', diffusion_advection_integrator,
+                    concentrations, u, v, tf.stack(divergences)
+                )
+
+                flow = (flow_u, flow_v)
+            elif self.dims == 3:
+                rho = tf.math.log(base_density + density_of_reactants)
+                u, v, w = flow  # Store unintegrated flow so that we're on the same timestep
+                flow_u, flow_v, flow_w, divergence = self.phase('flow_integrator', flow_integrator, rho, u, v, w)
+                concentrations = self.phase(
+                    'diffusion_advection_integrator', diffusion_advection_integrator, concentrations, u, v, w, divergence
+                )
+
+                flow = (flow_u, flow_v, flow_w)
+
+            if self.source_functions:
+                concentrations = tf.stack(self.phase('source_integrator', source_integrator, t, *tf.unstack(concentrations)))
+            return t + self.dt, (concentrations, flow)
+
+        # The individual phases remain available for inspection but stepping goes through a single compiled graph
         self.reaction_integrator = tf.function(reaction_integrator_curried)
         self.flow_integrator = tf.function(flow_integrator)
-        #self.diffusion_advection_integrator = tf.function(diffusion_advection_integrator) # original
-        self.diffusion_advection_integrator1 = tf.function(diffusion_advection_integrator1) # BJD added 25.6.2021
-        self.diffusion_advection_integrator2 = tf.function(diffusion_advection_integrator2) # BJD added 25.6.2021
-        self.diffusion_advection_integrator3 = tf.function(diffusion_advection_integrator3) # BJD added 25.6.2021
-
-    def step(self):
-        self.G, self.X, self.Y = self.reaction_integrator(self.G, self.X, self.Y)
-        density_of_reactants = (
-            self.params['density_G'] * self.G +
-            self.params['density_X'] * self.X +
-            self.params['density_Y'] * self.Y
-        )
+        self.diffusion_advection_integrator = tf.function(diffusion_advection_integrator)
+        self.source_integrator = tf.function(source_integrator)
+        self.compile_step(step)
 
-        if self.dims == 2:
-            u, v = self.u, self.v  # Store unintegrated flow so that we're on the same timestep
-            rho = tf.math.log(35.0 + density_of_reactants) # rho defined for self.G
+    @property
+    def G(self):
+        return self.concentrations[0]
 
-            self.u, self.v, divergence = self.flow_integrator(rho, self.u, self.v)
-            self.G = self.diffusion_advection_integrator1(self.G, u, v, divergence) # G calculated
+    @property
+    def X(self):
+        return self.concentrations[1]
 
-            rho = tf.math.log(36.0 + density_of_reactants) # rho defined for self.X
-            self.u, self.v, divergence = self.flow_integrator(rho, self.u, self.v)
-            self.X = self.diffusion_advection_integrator2(self.X, u, v, divergence) # X calculated
-                    
-            rho = tf.math.log(37.0 + density_of_reactants) # rho defined for self.Y
-            self.u, self.v, divergence = self.flow_integrator(rho, self.u, self.v)
-            self.Y = self.diffusion_advection_integrator3(self.Y, u, v, divergence) # Y calculated
+    @property
+    def Y(self):
+        return self.concentrations[2]
 
+    @property
+    def flow(self):
+        if self.dims == 2:
+            return (self.u, self.v)
+        elif self.dims == 3:
+            return (self.u, self.v, self.w)
+
+    @flow.setter
+    def flow(self, value):
+        if self.dims == 2:
+            self.u, self.v = value
         elif self.dims == 3:
-            rho = tf.math.log(self.params['base-density'] + density_of_reactants)
-            u, v, w = self.u, self.v, self.w  # Store unintegrated flow so that we're on the same timestep
-            self.u, self.v, self.w, divergence = self.flow_integrator(rho, self.u, self.v, self.w)
-            self.G, self.X, self.Y = self.diffusion_advection_integrator(self.G, self.X, self.Y, u, v, w, divergence)
-
-        zero = lambda t: 0
-        source_G = self.source_functions.get('G', zero)(self.t)
-        source_X = self.source_functions.get('X', zero)(self.t)
-        source_Y = self.source_functions.get('Y', zero)(self.t)
-        self.G += self.dt * source_G
-        self.X += self.dt * source_X
-        self.Y += self.dt * source_Y
-        self.t += self.dt
+            self.u, self.v, self.w = value
+
+    def state_fields(self, state):
+        concentrations, flow = state
+        G, X, Y = tf.unstack(concentrations)
+        fields = {'G': G, 'X': X, 'Y': Y}
+        fields.update(zip('uvw', flow))
+        return fields
+
+    @property
+    def state(self):
+        return (self.concentrations, self.flow)
+
+    @state.setter
+    def state(self, value):
+        self.concentrations, self.flow = value
 
     def numpy(self):
         if self.dims == 2:
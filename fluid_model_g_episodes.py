@@ -1,9 +1,12 @@
 import numpy as np
+import tensorflow as tf
 from util import bl_noise, l2_location
 from mpl_toolkits import mplot3d
 import pylab
 from matplotlib.animation import FuncAnimation
 from fluid_model_g import FluidModelG
+from snapshots import SnapshotWriter
+from sources import Source, gaussian_pulse, tanh_switch
 
 
 def nucleation_and_motion_in_G_gradient_2D(N=128, R=16):
@@ -28,13 +31,8 @@ def nucleation_and_motion_in_G_gradient_2D(N=128, R=16):
     dx = x[1] - x[0]
     x, y = np.meshgrid(x, x, indexing='ij')
 
-    def source_G(t):
-        center = np.exp(-0.5*(t-5)**2) * 10
-        gradient = (1+np.tanh(t-40)) * 0.0005
-        return -np.exp(-0.5*(x*x+y*y))* center + (x+8) * gradient
-
     source_functions = {
-        'G': source_G,
+        'G': Source(-np.exp(-0.5*(x*x+y*y)), gaussian_pulse(5, 10)) + Source(x+8, tanh_switch(40, 0.0005)),
     }
 
     flow = [0*x, 0*x]
@@ -81,8 +79,7 @@ def nucleation_and_motion_in_G_gradient_2D(N=128, R=16):
     pylab.ylim(-0.1, 0.1)
 
     def update(frame):
-        for _ in range(20):
-            fluid_model_g.step()
+        fluid_model_g.advance(20)
         G, X, Y, u, v = get_data()
         plots[0].set_ydata(G)
         plots[1].set_ydata(X)
@@ -102,7 +99,7 @@ def nucleation_and_motion_in_G_gradient_2D(N=128, R=16):
     pylab.show()
 
 
-def nucleation_3D(animated=False, N=128, R=20):
+def nucleation_3D(animated=False, N=128, R=20, snapshot_path='/tmp/model_g', snapshot_interval=1.0, compress=False, history=10):
     params = {
         "A": 3.4,
         "B": 13.5,
@@ -125,12 +122,8 @@ def nucleation_3D(animated=False, N=128, R=20):
     x, y, z = np.meshgrid(x, x, x, indexing='ij')
 
 
-    def source_G(t):
-        center = np.exp(-0.5*(t-5)**2) * 10
-        return -np.exp(-0.5*(x*x+y*y+z*z)) * center
-
     source_functions = {
-        'G': source_G,
+        'G': Source(-np.exp(-0.5*(x*x+y*y+z*z)), gaussian_pulse(5, 10)),
     }
 
     # We need some noise to break spherical symmetry
@@ -194,30 +187,26 @@ def nucleation_3D(animated=False, N=128, R=20):
         pylab.show()
     else:
         from datetime import datetime
-        from pathlib import Path
         start = datetime.now()
 
-        num_steps = int(1.0/dt)
+        num_steps = int(snapshot_interval/dt)
         print("Starting simulation {} steps at a time".format(num_steps))
 
-        path = Path("/tmp/model_g")
-        path.mkdir(exist_ok=True)
-        while True:
-            for _ in range(num_steps):
-                fluid_model_g.step()
-            print("Saving a snapshot into {}".format(path))
-            G, X, Y, (u, v, w) = fluid_model_g.numpy()
-            np.save(path / 'G.npy', G)
-            np.save(path / 'X.npy', X)
-            np.save(path / 'Y.npy', Y)
-            np.save(path / 'u.npy', u)
-            np.save(path / 'v.npy', v)
-            np.save(path / 'w.npy', w)
-            print("Saved everything")
-
-            wall_clock_time = (datetime.now() - start).total_seconds()
-            print("t={}, wall clock time={} s, efficiency={}".format(fluid_model_g.t, wall_clock_time, fluid_model_g.t / wall_clock_time))
-            print("max|G|={}, max|u|={}".format(abs(G).max(), abs(u).max()))
+        # Snapshots are written in the background while the next steps run
+        writer = SnapshotWriter(snapshot_path, compress=compress, history=history)
+        try:
+            index = 0
+            while True:
+                fluid_model_g.advance(num_steps)
+                print("Saving snapshot {} into {}".format(index, snapshot_path))
+                writer.submit(index, fluid_model_g.t, fluid_model_g.fields())
+                index += 1
+
+                wall_clock_time = (datetime.now() - start).total_seconds()
+                print("t={}, wall clock time={} s, efficiency={}".format(fluid_model_g.t, wall_clock_time, fluid_model_g.t / wall_clock_time))
+                print("max|G|={}, max|u|={}".format(float(tf.reduce_max(tf.abs(fluid_model_g.G))), float(tf.reduce_max(tf.abs(fluid_model_g.u)))))
+        finally:
+            writer.close()
 
 
 
@@ -0,0 +1,56 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FramePipeline(object):
+    """
+    Converts and encodes video frames off the simulation thread
+
+    Submitting a frame only hands over references to the (immutable) field tensors. A pool of `workers` threads turns
+    them into frames with `convert` while a single encoder thread appends the finished frames to `writer` in the order
+    they were submitted. At most `max_pending` frames are in flight so a slow encoder holds the simulation back instead
+    of piling up frames in memory.
+    """
+
+    def __init__(self, writer, convert, workers=2, max_pending=4):
+        self.writer = writer
+        self.convert = convert
+        self.error = None
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, fields):
+        """
+        Queue the frame for the fields (a dict of tensors)
+        """
+        self._check()
+        self.queue.put(self.executor.submit(self.convert, dict(fields)))
+
+    def close(self):
+        """
+        Wait for the queued frames to be encoded and close the writer
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.executor.shutdown()
+        self.writer.close()
+        self._check()
+
+    def _check(self):
+        if self.error is not None:
+            raise RuntimeError("Converting or encoding a video frame failed") from self.error
+
+    def _run(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                self.writer.append_data(frame.result())
+            except Exception as error:
+                self.error = error
@@ -2,6 +2,7 @@ import warnings
 import tensorflow as tf
 import numpy as np
 from pde_solver import PDESolver
+from sources import Source
 from integrators.model_g import polynomial_order_4_centered as reaction_integrator
 from integrators.model_g import steady_state
 
@@ -22,16 +23,26 @@ DEFAULT_PARAMS = {
 class ModelG(PDESolver):
     """
     Model G Reaction Diffusion system
+
+    With `batched` the concentrations have a leading ensemble axis and every parameter may be given either as a
+    single value or as one value per member.
+
+    The fields are kept in `dtype`. The stiff reaction polynomial can run at a higher `reaction_dtype` (say float64
+    for float32 fields).
     """
 
-    def __init__(self, concentration_G, concentration_X, concentration_Y, dx, dt=None, params=None, source_functions=None):
+    def __init__(self, concentration_G, concentration_X, concentration_Y, dx, dt=None, params=None, source_functions=None, real_fft=True, batched=False, dtype='float64', reaction_dtype=None):
         if dt is None:
             dt = 0.1 * dx
 
         if dt > 0.5 * dx:
             warnings.warn("Time increment {} too large for simulation stability with grid constant {}".format(dt, dx))
 
-        super().__init__(dx, dt, concentration_G.shape)
+        if batched:
+            super().__init__(dx, dt, concentration_G.shape[1:], real_fft=real_fft, batch_size=concentration_G.shape[0], dtype=dtype)
+        else:
+            super().__init__(dx, dt, concentration_G.shape, real_fft=real_fft, dtype=dtype)
+        self.reaction_dtype = tf.as_dtype(reaction_dtype or dtype)
 
         if concentration_X.shape != concentration_Y.shape or concentration_X.shape != concentration_G.shape:
             raise ValueError("Concentration shapes must match")
@@ -39,54 +50,82 @@ class ModelG(PDESolver):
         self.params = params or DEFAULT_PARAMS
         self.source_functions = source_functions or {}
 
-        self.G = tf.constant(concentration_G, dtype="float64")
-        self.X = tf.constant(concentration_X, dtype="float64")
-        self.Y = tf.constant(concentration_Y, dtype="float64")
-
-        if self.dims == 1:
-            omega2 = self.omega_x**2
-        elif self.dims == 2:
-            omega_x, omega_y = self.omega_x, self.omega_y
-            omega2 = omega_x**2 + omega_y**2
-        elif self.dims == 3:
-            omega_x, omega_y, omega_z = self.omega_x, self.omega_y, self.omega_z
-            omega2 = omega_x**2 + omega_y**2 + omega_z**2
-        else:
+        # G, X and Y are kept stacked so that diffusion transforms all of them in one batched call
+        self.concentrations = tf.constant(np.array([concentration_G, concentration_X, concentration_Y]), dtype=self.dtype)
+
+        self.build()
+
+    def build(self):
+        if self.dims > 3:
             raise ValueError('Only up to 3D supported')
 
-        delta = tf.cast(-omega2 * self.dt, 'complex128')
-        decay_G = tf.exp(self.params['D_G'] * delta)
-        decay_X = tf.exp(self.params['D_X'] * delta)
-        decay_Y = tf.exp(self.params['D_Y'] * delta)
-        def diffusion_integrator(*cons):
+        omega = self.wave_numbers()
+        D = [self.batch_param(self.params[key]) for key in ('D_G', 'D_X', 'D_Y')]
+        diffusivity = tf.constant(np.reshape(np.stack(D), [3] + self.batch_shape + [1] * self.dims), self.dtype)
+        def diffusion_integrator(concentrations):
+            f = self.fft(concentrations)
+            f *= self.decay(diffusivity * sum(o**2 for o in omega))
+            return tf.cast(self.ifft(f), self.dtype)
+
+        A, B, k2, k_2, k5 = [self.batch_param(self.params[key]) for key in ('A', 'B', 'k2', 'k-2', 'k5')]
+        def reaction_integrator_curried(con_G, con_X, con_Y):
+            result = reaction_integrator(
+                *[tf.cast(c, self.reaction_dtype) for c in (con_G, con_X, con_Y)],
+                self.dt, A, B, k2, k_2, k5
+            )
+            return tuple(tf.cast(c, self.dtype) for c in result)
+
+        # Source terms that would change the concentrations by less than this in a time step are skipped
+        source_tolerance = self.params.get('source-tolerance', 1e-12)
+
+        def source_integrator(t, G, X, Y):
+            """
+            Sources are evaluated inside the step graph. See `sources.Source` or write them with TensorFlow ops on `t`
+            """
             result = []
-            for decay, concentration in zip([decay_G, decay_X, decay_Y], cons):
-                f = self.fft(tf.cast(concentration, 'complex128'))
-                f *= decay
-                result.append(tf.cast(tf.math.real(self.ifft(f)), 'float64'))
+            for name, concentration in zip('GXY', (G, X, Y)):
+                source = self.source_functions.get(name)
+                if isinstance(source, Source):
+                    concentration = source.apply(t, concentration, self.dt, source_tolerance)
+                elif source is not None:
+                    concentration += self.dt * tf.cast(source(t), concentration.dtype)
+                result.append(concentration)
             return result
 
-        reaction_integrator_curried = lambda con_G, con_X, con_Y: reaction_integrator(
-            con_G, con_X, con_Y,
-            self.dt, self.params['A'], self.params['B'], self.params['k2'], self.params['k-2'], self.params['k5']
-        )
+        def step(t, concentrations):
+            concentrations = self.phase('diffusion_integrator', diffusion_integrator, concentrations)
+            G, X, Y = self.phase('reaction_integrator', reaction_integrator_curried, *tf.unstack(concentrations))
+            G, X, Y = self.phase('source_integrator', source_integrator, t, G, X, Y)
+            return t + self.dt, tf.stack([G, X, Y])
 
         self.diffusion_integrator = tf.function(diffusion_integrator)
         self.reaction_integrator = tf.function(reaction_integrator_curried)
+        self.source_integrator = tf.function(source_integrator)
+        self.compile_step(step)
+
+    @property
+    def G(self):
+        return self.concentrations[0]
+
+    @property
+    def X(self):
+        return self.concentrations[1]
+
+    @property
+    def Y(self):
+        return self.concentrations[2]
+
+    def state_fields(self, state):
+        G, X, Y = tf.unstack(state)
+        return {'G': G, 'X': X, 'Y': Y}
+
+    @property
+    def state(self):
+        return self.concentrations
 
-    def step(self):
-        values = self.diffusion_integrator(self.G, self.X, self.Y)
-        self.G, self.X, self.Y = values
-        values = self.reaction_integrator(self.G, self.X, self.Y)
-        self.G, self.X, self.Y = values
-        zero = lambda t: 0
-        source_G = self.source_functions.get('G', zero)(self.t)
-        source_X = self.source_functions.get('X', zero)(self.t)
-        source_Y = self.source_functions.get('Y', zero)(self.t)
-        self.G += self.dt * source_G
-        self.X += self.dt * source_X
-        self.Y += self.dt * source_Y
-        self.t += self.dt
+    @state.setter
+    def state(self, value):
+        self.concentrations = value
 
     def numpy(self):
         return (
@@ -1,10 +1,12 @@
 # coding: utf-8
 import numpy as np
+import tensorflow as tf
 from util import bl_noise, l2_location
 from mpl_toolkits import mplot3d
 import pylab
 from matplotlib.animation import FuncAnimation
 from model_g import ModelG
+from sources import Source, gaussian_pulse, tanh_switch
 
 def self_stabilizing_soliton_2D():
     params = {
@@ -50,8 +52,7 @@ def self_stabilizing_soliton_2D():
     pylab.ylim(-0.03, 0.03)
 
     def update(frame):
-        for _ in range(5):
-            model_g.step()
+        model_g.advance(5)
         G, X, Y = get_data()
         plots[0].set_ydata(G)
         plots[1].set_ydata(X)
@@ -110,8 +111,7 @@ def self_stabilizing_soliton_3D():
     pylab.ylim(-0.4, 0.4)
 
     def update(frame):
-        for _ in range(5):
-            model_g.step()
+        model_g.advance(5)
         G, X, Y = get_data()
         plots[0].set_ydata(G)
         plots[1].set_ydata(X)
@@ -142,18 +142,14 @@ def nucleation_and_motion_in_G_gradient_1D():
     x = np.linspace(-24, 24, 512)
     dx = x[1] - x[0]
 
-    def source_G(t):
-        center = -np.exp(-0.1*(t-5)**2) * 5
-        gradient = (1+np.tanh(t-50)) * 0.0005
-        print("t={}\tcenter={}\tgradient={}".format(t, center, gradient))
-        return np.exp(-0.25*x*x) * center + (x*0.5 + 7) * gradient
+    source_G = Source(np.exp(-0.25*x*x), gaussian_pulse(5, -5, rate=0.1)) + Source(x*0.5 + 7, tanh_switch(50, 0.0005))
 
     def source_X(t):
-        center = np.exp(-0.1*(t-5)**2) * 5
+        center = tf.exp(-0.1*(t-5)**2) * 5
         return -np.exp(-0.25*x*x) * center
 
     def source_Y(t):
-        center = np.exp(-0.1*(t-5)**2) * 0
+        center = tf.exp(-0.1*(t-5)**2) * 0
         return np.exp(-0.25*x*x) * center
 
     source_functions = {
@@ -191,8 +187,8 @@ def nucleation_and_motion_in_G_gradient_1D():
     pylab.ylim(-0.1, 0.1)
 
     def update(frame):
-        for _ in range(32):
-            model_g.step()
+        model_g.advance(32)
+        print("t = {}".format(model_g.t))
         G, X, Y = get_data()
         plots[0].set_ydata(G)
         plots[1].set_ydata(X)
@@ -223,14 +219,8 @@ def nucleation_and_motion_in_G_gradient_2D():
     dx = x[1] - x[0]
     x, y = np.meshgrid(x, x)
 
-    def source_G(t):
-        center = np.exp(-0.5*(t-5)**2) * 10
-        gradient = (1+np.tanh(t-40)) * 0.0005
-        # print("t = {}\tcenter potential = {}\tx-gradient = {}".format(t, center, gradient))
-        return -np.exp(-0.5*(x*x+y*y))* center + (x+8) * gradient
-
     source_functions = {
-        'G': source_G,
+        'G': Source(-np.exp(-0.5*(x*x+y*y)), gaussian_pulse(5, 10)) + Source(x+8, tanh_switch(40, 0.0005)),
     }
 
     r2 = x*x+y*y
@@ -271,8 +261,7 @@ def nucleation_and_motion_in_G_gradient_2D():
     pylab.ylim(-0.1, 0.1)
 
     def update(frame):
-        for _ in range(20):
-            model_g.step()
+        model_g.advance(20)
         G, X, Y = get_data()
         plots[0].set_ydata(G)
         plots[1].set_ydata(X)
@@ -290,8 +279,11 @@ def nucleation_and_motion_in_G_gradient_2D():
     pylab.show()
 
 
-def random_2D():
-    r = np.random.randn
+def random_2D(batch_size=4):
+    """
+    A small ensemble of random parameter draws run side by side as one batched model
+    """
+    r = lambda: np.random.randn(batch_size)
     params = {
         "A": 2 + r()*0.1,
         "B": 10 + r(),
@@ -308,24 +300,21 @@ def random_2D():
     dx = x[1] - x[0]
     x, y = np.meshgrid(x, x)
 
-    def source_G(t):
-        center = np.exp(-0.5*(t-20)**2) * 10
-        gradient = (1+np.tanh(t-40)) * 0.0005
-        print("t = {}\tcenter potential = {}\tx-gradient = {}".format(t, center, gradient))
-        return -np.exp(-0.5*(x*x+y*y)) * center + x * gradient
+    source_G = Source(-np.exp(-0.5*(x*x+y*y)), gaussian_pulse(20, 10)) + Source(x, tanh_switch(40, 0.0005))
 
     source_functions = {
         'G': source_G,
     }
 
     model_g = ModelG(
-        bl_noise(x.shape)*0.01,
-        bl_noise(x.shape)*0.01,
-        bl_noise(x.shape)*0.01,
+        np.array([bl_noise(x.shape)*0.01 for _ in range(batch_size)]),
+        np.array([bl_noise(x.shape)*0.01 for _ in range(batch_size)]),
+        np.array([bl_noise(x.shape)*0.01 for _ in range(batch_size)]),
         dx,
         0.1*dx,
         params,
         source_functions=source_functions,
+        batched=True,
     )
 
     def get_data():
@@ -333,39 +322,38 @@ def random_2D():
         x_scale = 0.1
         y_scale = 0.1
         return (
-            G[64],
-            X[64] * x_scale,
-            Y[64] * y_scale,
+            G[:, 64],
+            X[:, 64] * x_scale,
+            Y[:, 64] * y_scale,
         )
 
-    G, X, Y = get_data()
     plots = []
-    plots.extend(pylab.plot(x[0], G))
-    plots.extend(pylab.plot(x[0], X))
-    plots.extend(pylab.plot(x[0], Y))
+    for data in get_data():
+        plots.extend(pylab.plot(x[0], data.T))
     pylab.ylim(-0.5, 0.5)
 
     def update(frame):
         model_g.step()
-        G, X, Y = get_data()
-        plots[0].set_ydata(G)
-        plots[1].set_ydata(X)
-        plots[2].set_ydata(Y)
+        print("t = {}".format(model_g.t))
+        for plot, data in zip(plots, np.concatenate(get_data())):
+            plot.set_ydata(data)
         return plots
 
     FuncAnimation(pylab.gcf(), update, frames=range(100), init_func=lambda: plots, blit=True, repeat=True, interval=20)
     pylab.show()
 
     G, X, Y = model_g.numpy()
-    plots = [pylab.imshow(X)]
+    fig, axs = pylab.subplots(1, batch_size, squeeze=False)
+    plots = [ax.imshow(X_member) for ax, X_member in zip(axs.flat, X)]
 
     def update(frame):
         model_g.step()
         G, X, Y = model_g.numpy()
-        plots[0].set_data(X)
+        for plot, X_member in zip(plots, X):
+            plot.set_data(X_member)
         return plots
 
-    FuncAnimation(pylab.gcf(), update, frames=range(100), init_func=lambda: plots, blit=True, repeat=True, interval=20)
+    FuncAnimation(fig, update, frames=range(100), init_func=lambda: plots, blit=True, repeat=True, interval=20)
     pylab.show()
 
 
@@ -387,11 +375,7 @@ def random_3D():
     dx = x[1] - x[0]
     x, y, z = np.meshgrid(x, x, x)
 
-    def source_G(t):
-        center = np.exp(-0.5*(t-20)**2) * 10
-        gradient = (1+np.tanh(t-40)) * 0.0005
-        print("t = {}\tcenter potential = {}\tx-gradient = {}".format(t, center, gradient))
-        return -np.exp(-0.5*(x*x+y*y+z*z)) * center + x * gradient
+    source_G = Source(-np.exp(-0.5*(x*x+y*y+z*z)), gaussian_pulse(20, 10)) + Source(x, tanh_switch(40, 0.0005))
 
     source_functions = {
         'G': source_G,
@@ -425,6 +409,7 @@ def random_3D():
 
     def update(frame):
         model_g.step()
+        print("t = {}".format(model_g.t))
         G, X, Y = get_data()
         plots[0].set_ydata(G)
         plots[1].set_ydata(X)
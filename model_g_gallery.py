@@ -31,102 +31,75 @@ def random_0D_trajectories():
     show()
 
 
-def random_1D_fields():
+def random_params(batch_size):
+    return {
+        "A": rand(batch_size) * 20,
+        "B": rand(batch_size) * 20,
+        "k2": rand(batch_size) * 2,
+        "k-2": rand(batch_size) * 2,
+        "k5": rand(batch_size) * 2,
+        "D_G": 1.0,
+        "D_X": rand(batch_size) * 4,
+        "D_Y": rand(batch_size) * 4,
+    }
+
+
+def random_fields(x, dx, duration, batch_size, noise_scale=1.0):
+    """
+    Run a whole batch of random parameter draws as one ensemble and yield the members that stay bounded
+    """
+    while True:
+        params = random_params(batch_size)
+        model_g = ModelG(
+            array([bl_noise(x.shape) * noise_scale for _ in range(batch_size)]),
+            array([bl_noise(x.shape) * noise_scale for _ in range(batch_size)]),
+            array([bl_noise(x.shape) * noise_scale for _ in range(batch_size)]),
+            dx,
+            params=params,
+            batched=True
+        )
+        # A member that blows up only spoils its own slice of the batch
+        with errstate(all='ignore'):
+            model_g.advance(int(ceil(duration / model_g.dt)))
+            G, X, Y = model_g.numpy()
+
+        for i in range(batch_size):
+            member = {key: float(value[i]) if ndim(value) else value for key, value in params.items()}
+            if abs(X[i]).max() < 100:
+                print("Done", member)
+                yield G[i], X[i], Y[i]
+            else:
+                print("Rejected", member)
+
+
+def random_1D_fields(batch_size=64):
     x = linspace(-20, 20, 512)
     dx = x[1] - x[0]
-    noise_scale = 1.0
 
     fig, axs = subplots(2, 3)
-    for ax_ in axs:
-        for ax in ax_:
-            while True:
-                params = {
-                    "A": rand() * 20,
-                    "B": rand() * 20,
-                    "k2": rand() * 2,
-                    "k-2": rand() * 2,
-                    "k5": rand() * 2,
-                    "Dx": rand() * 4,
-                    "Dy": rand() * 4,
-                }
-                model_g = ModelG(
-                    bl_noise(x.shape) * noise_scale,
-                    bl_noise(x.shape) * noise_scale,
-                    bl_noise(x.shape) * noise_scale,
-                    dx,
-                    params=params
-                )
-
-                while model_g.t < 20:
-                    model_g.step()
-                    if rand() < 0.05:
-                        G, X, Y = model_g.numpy()
-                        if abs(X).max() >= 100:
-                            break
-
-                G, X, Y = model_g.numpy()
-                if abs(X).max() < 100:
-                    break
-                print("Rejected", params)
-
-            print("Done", params)
-
-            G /= abs(G).max()
-            X /= abs(X).max()
-            Y /= abs(Y).max()
-
-            ax.plot(x, G)
-            ax.plot(x, X)
-            ax.plot(x, Y)
+    for ax, (G, X, Y) in zip(axs.flat, random_fields(x, dx, 20, batch_size)):
+        G /= abs(G).max()
+        X /= abs(X).max()
+        Y /= abs(Y).max()
+
+        ax.plot(x, G)
+        ax.plot(x, X)
+        ax.plot(x, Y)
     show()
 
 
-def random_2D_fields():
+def random_2D_fields(batch_size=16):
     x = linspace(-20, 20, 512)
     dx = x[1] - x[0]
     x, y = meshgrid(x, x)
-    noise_scale = 1.0
 
     fig, axs = subplots(2, 3)
-    for ax_ in axs:
-        for ax in ax_:
-            while True:
-                params = {
-                    "A": rand() * 20,
-                    "B": rand() * 20,
-                    "k2": rand() * 2,
-                    "k-2": rand() * 2,
-                    "k5": rand() * 2,
-                    "Dx": rand() * 4,
-                    "Dy": rand() * 4,
-                }
-                model_g = ModelG(
-                    bl_noise(x.shape) * noise_scale,
-                    bl_noise(x.shape) * noise_scale,
-                    bl_noise(x.shape) * noise_scale,
-                    dx,
-                    params=params
-                )
-
-                while model_g.t < 3:
-                    model_g.step()
-                    if rand() < 0.05:
-                        G, X, Y = model_g.numpy()
-                        if abs(X).max() >= 100:
-                            break
-
-                G, X, Y = model_g.numpy()
-                if abs(X).max() < 100:
-                    break
-                print("...Rejected", params)
-
-            print("Done", params)
-
-            G /= abs(G).max()
-            X /= abs(X).max()
-            Y /= abs(Y).max()
+    for ax, (G, X, Y) in zip(axs.flat, random_fields(x, dx, 3, batch_size)):
+        G /= abs(G).max()
+        X /= abs(X).max()
+        Y /= abs(Y).max()
 
-            ax.imshow(X, extent=(-20, 20, -20, 20))
+        ax.imshow(X, extent=(-20, 20, -20, 20))
     show()
 
 if __name__ == '__main__':
@@ -1,72 +1,449 @@
+import json
+import os
+import warnings
 import tensorflow as tf
 import numpy as np
 
 
+class SimulationDiverged(RuntimeError):
+    """
+    Raised when the watchdog finds non-finite values or fields beyond their limits
+    """
+
+
+class Watchdog(object):
+    """
+    Settings for the blow-up check done inside the compiled multi-step integrator
+
+    Every `check_interval` steps and at the end of each `advance` all fields are checked for non-finite values and
+    against `limits`, a dict of maximum absolute values by field name such as {'X': 100, 'u': 10}. A trip stops the
+    loop right away. By default the run is then aborted with `SimulationDiverged`. With `rollback` the solver instead
+    goes back to the state it had at the start of the `advance` call, splits every time step into `refinement`
+    smaller ones and tries again, giving up after `max_retries` refinements.
+    """
+
+    def __init__(self, check_interval=10, limits=None, rollback=False, refinement=2, max_retries=3):
+        self.check_interval = check_interval
+        self.limits = dict(limits or {})
+        self.rollback = rollback
+        self.refinement = refinement
+        self.max_retries = max_retries
+
+
 class PDESolver(object):
     """
     Base class for partial differential equation solvers
+
+    With `real_fft` the fields are assumed to be real and the transforms only keep the non-negative half of the
+    spectrum along the last axis. The omegas (and hence every kernel derived from them) are then half-spectrum too.
+
+    With `batch_size` the solver runs an ensemble of that many independent members on the grid `shape`. Every field
+    gets a leading batch axis and the transforms work on the innermost axes, so all members go through the same
+    batched graph.
+
+    `dtype` is the precision of the fields, 'float64' or 'float32'. The spectral kernels and transforms use the
+    matching complex type. Time is always kept in float64.
     """
 
-    def __init__(self, dx, dt, shape):
+    def __init__(self, dx, dt, shape, real_fft=False, batch_size=None, dtype='float64'):
+        self.dtype = tf.as_dtype(dtype)
+        if self.dtype not in (tf.float32, tf.float64):
+            raise ValueError("Unsupported dtype {}".format(dtype))
+        self.complex_dtype = tf.complex64 if self.dtype == tf.float32 else tf.complex128
         self.dx = dx
         self.dt = dt
-        self.t = 0
+        self.t = 0.0
+        self.shape = tuple(shape)
+        self.real_fft = real_fft
+        self.batch_size = batch_size
+        self.watchdog = None
+        # Optional `profiling.PhaseProfiler`
+        self.profiler = None
+        # Number of actual time steps taken for each step asked of `advance`. Goes up when the watchdog refines dt.
+        self.substeps = 1
 
         omega = []
-        for s in shape:
-            wave_numbers = np.arange(s)
-            wave_numbers -= s * (2*wave_numbers > s)  # Deal with TensorFlow's uncentered FFT
+        for i, s in enumerate(shape):
+            if real_fft and i == len(shape) - 1:
+                wave_numbers = np.arange(s // 2 + 1)  # rfft only keeps the non-negative frequencies of the last axis
+            else:
+                wave_numbers = np.arange(s)
+                wave_numbers -= s * (2*wave_numbers > s)  # Deal with TensorFlow's uncentered FFT
             expected_span = 2*np.pi
             actual_span = s*dx
             omega.append(wave_numbers * expected_span / actual_span)
-        self.omega = np.meshgrid(*omega, indexing='ij')
+        # One vector per axis shaped to broadcast against the others. Kernels built from them stay that small until
+        # they meet a spectrum inside the step graph where XLA fuses them into the product.
+        self.omega = np.meshgrid(*omega, indexing='ij', sparse=True)
         self.dims = len(shape)
         # The naming is a bit off. These are not actual 'kernels'.
         # They are discrete fourier transforms of the periodic versions of the kernels
         if self.dims == 1:
-            self.fft = tf.signal.fft
-            self.ifft = tf.signal.ifft
             self.omega_x = self.omega[0]
         elif self.dims == 2:
-            self.fft = tf.signal.fft2d
-            self.ifft = tf.signal.ifft2d
-
             self.omega_x = self.omega[0]
             self.omega_y = self.omega[1]
         elif self.dims == 3:
-            self.fft = tf.signal.fft3d
-            self.ifft = tf.signal.ifft3d
-
             self.omega_x = self.omega[0]
             self.omega_y = self.omega[1]
             self.omega_z = self.omega[2]
         else:
             raise ValueError('{} dimensions not supported'.format(self.dims))
 
+        if real_fft:
+            forward, inverse = [
+                (tf.signal.rfft, tf.signal.irfft),
+                (tf.signal.rfft2d, tf.signal.irfft2d),
+                (tf.signal.rfft3d, tf.signal.irfft3d),
+            ][self.dims - 1]
+            fft_length = tf.constant(self.shape, 'int32')
+            self.fft = lambda x: forward(tf.cast(x, self.dtype), fft_length=fft_length)
+            self.ifft = lambda f: inverse(f, fft_length=fft_length)
+        else:
+            forward, inverse = [
+                (tf.signal.fft, tf.signal.ifft),
+                (tf.signal.fft2d, tf.signal.ifft2d),
+                (tf.signal.fft3d, tf.signal.ifft3d),
+            ][self.dims - 1]
+            self.fft = lambda x: forward(tf.cast(x, self.complex_dtype))
+            self.ifft = inverse
+
+    def wave_numbers(self, mirrored=False):
+        """
+        The per-axis omegas as constants of the field dtype. With `mirrored` the Nyquist modes, which are their own
+        negatives on the grid, have their sign flipped.
+        """
+        omega = self.omega
+        if mirrored:
+            omega = [o * np.where(np.isclose(abs(o), np.pi / self.dx), -1, 1) for o in omega]
+        return [tf.constant(o, self.dtype) for o in omega]
+
+    def decay(self, rate):
+        """
+        Spectral kernel damping each mode at `rate` over a time step. Called inside the step graph on rates built from
+        `wave_numbers()` the kernel is computed on the fly as part of its product with the spectrum instead of being
+        kept around at the size of the grid.
+        """
+        return tf.cast(tf.exp(-rate * self.dt), self.complex_dtype)
+
+    @property
+    def batch_shape(self):
+        return [self.batch_size] if self.batch_size else []
+
+    def batch_param(self, value):
+        """
+        Shape a parameter so that it broadcasts against a single (batched) field.
+        Batched solvers take one value per member for any parameter. Plain numbers are passed through.
+        """
+        if not self.batch_size or value is None:
+            return value
+        value = np.asarray(value, 'float64')
+        if value.ndim and value.shape != (self.batch_size,):
+            raise ValueError("Expected a single value or one per ensemble member, got shape {}".format(value.shape))
+        return np.broadcast_to(value, self.batch_shape).reshape(self.batch_shape + [1] * self.dims)
+
+    @property
+    def t(self):
+        """
+        Simulation time. Kept as a tensor so that compiled steps can advance it without a round trip to Python.
+        """
+        return float(self._t)
+
+    @t.setter
+    def t(self, value):
+        self._t = tf.cast(value, 'float64')
+
+    def build(self):
+        """
+        Set up the kernels and compiled integrators for the current time step
+        """
+        raise NotImplementedError("{} can't be rebuilt for a new time step".format(type(self).__name__))
+
+    def set_time_step(self, dt):
+        """
+        Switch to time step `dt` rebuilding everything that depends on it
+        """
+        self.dt = dt
+        self.build()
+
+    def state_fields(self, state):
+        """
+        Named fields of `state` as a dict. Subclasses map their `state` structure to the names used by `fields()`.
+        """
+        return {str(i): field for i, field in enumerate(tf.nest.flatten(state))}
+
+    def fields(self):
+        return self.state_fields(self.state)
+
+    def compile_step(self, step):
+        """
+        Compile `step(t, state) -> (t, state)` into single step and multi-step integrators.
+        Subclasses expose their fields as a (nested) tuple through the `state` property.
+        """
+        def advance(t, state, n_steps):
+            def body(i, t, state):
+                t, state = step(t, state)
+                return i + 1, t, state
+            _, t, state = tf.while_loop(lambda i, t, state: i < n_steps, body, (0, t, state))
+            return t, state
+
+        def guarded_advance(t, state, n_steps, check_interval, limits):
+            def healthy(state):
+                result = tf.constant(True)
+                for field, limit in zip(self.state_fields(state).values(), tf.unstack(limits)):
+                    result = tf.logical_and(result, tf.reduce_all(tf.math.is_finite(field)))
+                    result = tf.logical_and(result, tf.reduce_max(tf.abs(field)) <= limit)
+                return result
+
+            def body(i, t, state, ok):
+                t, state = step(t, state)
+                i += 1
+                ok = tf.cond(
+                    tf.logical_or(i % check_interval == 0, i == n_steps),
+                    lambda: healthy(state),
+                    lambda: ok
+                )
+                return i, t, state, ok
+            i, t, state, ok = tf.while_loop(
+                lambda i, t, state, ok: tf.logical_and(i < n_steps, ok), body, (0, t, state, tf.constant(True))
+            )
+            return t, state, ok, i
+
+        self.step_function = step
+        self.step_integrator = tf.function(step, jit_compile=True)
+        self.advance_integrator = tf.function(advance, jit_compile=True)
+        self.guarded_advance_integrator = tf.function(guarded_advance, jit_compile=True)
+
+    def phase(self, name, function, *args):
+        """
+        Run the step phase `function`. Inside the compiled step this is a plain call. When a profiler splits the
+        phases the step runs eagerly and the compiled version of the phase (the tf.function in attribute `name`)
+        is run and timed instead.
+        """
+        if self.profiler is not None and self.profiler.split_phases and tf.executing_eagerly():
+            return self.profiler.call(name, getattr(self, name), *args)
+        return function(*args)
+
+    def step(self):
+        self._t, self.state = self.step_integrator(self._t, self.state)
+
+    def advance(self, n_steps):
+        """
+        Take `n_steps` time steps inside the graph without returning control to Python in between.
+        After the watchdog has refined the time step each of them is made up of `substeps` smaller steps.
+        """
+        n_steps *= self.substeps
+        if self.profiler is None:
+            self._advance(n_steps)
+            return
+
+        self.profiler.begin(n_steps)
+        if self.profiler.split_phases:
+            self.profiler.call('advance', self._advance_phases, n_steps)
+        else:
+            self.profiler.call('advance', self._advance, n_steps)
+        self.profiler.end(n_steps)
+
+    def _advance_phases(self, n_steps):
+        """
+        Take `n_steps` time steps running the phases of every step one by one (see `phase`). The watchdog only
+        looks at the fields at the end and can't roll back.
+        """
+        for _ in range(n_steps):
+            self._t, self.state = self.step_function(self._t, self.state)
+        if self.watchdog is not None:
+            self.watchdog_limits(self.state)
+            problems = self.problems()
+            if problems:
+                raise SimulationDiverged("Simulation diverged by t = {}: {}".format(self.t, ", ".join(problems)))
+
+    def _advance(self, n_steps):
+        if self.watchdog is None:
+            self._t, self.state = self.advance_integrator(self._t, self.state, tf.constant(n_steps, 'int32'))
+            return
+
+        # Tensors are immutable so holding on to the current ones is all the in-memory checkpoint needs
+        t, state = self._t, self.state
+        retries = 0
+        limits = self.watchdog_limits(state)
+        while True:
+            new_t, new_state, ok, steps_taken = self.guarded_advance_integrator(
+                t, state,
+                tf.constant(n_steps, 'int32'),
+                tf.constant(self.watchdog.check_interval, 'int32'),
+                tf.constant(limits, self.dtype)
+            )
+            if ok:
+                self._t, self.state = new_t, new_state
+                return
+
+            diagnostic = "Simulation diverged after {} steps at t = {}: {}".format(
+                int(steps_taken), float(new_t), self.diagnose(new_state)
+            )
+            if not self.watchdog.rollback or retries >= self.watchdog.max_retries:
+                raise SimulationDiverged(diagnostic)
+            refinement = self.watchdog.refinement
+            warnings.warn("{}. Rolling back to t = {} and retrying with dt = {}".format(
+                diagnostic, float(t), self.dt / refinement
+            ))
+            self.set_time_step(self.dt / refinement)
+            self.substeps *= refinement
+            n_steps *= refinement
+            retries += 1
+
+    def watchdog_limits(self, state):
+        """
+        The watchdog limits for the fields of `state` in order, infinite where there is none
+        """
+        names = list(self.state_fields(state))
+        unknown = sorted(set(self.watchdog.limits) - set(names))
+        if unknown:
+            raise ValueError("Watchdog limits for unknown fields {}. The fields are {}.".format(
+                ", ".join(unknown), ", ".join(names)
+            ))
+        return [self.watchdog.limits.get(name, np.inf) for name in names]
+
+    def diagnose(self, state=None):
+        """
+        Describe the fields of `state` (the current state by default) that are non-finite or beyond the watchdog limits
+        """
+        return ", ".join(self.problems(state)) or "no problems found"
+
+    def problems(self, state=None):
+        if state is None:
+            state = self.state
+        limits = self.watchdog.limits if self.watchdog else {}
+        problems = []
+        for name, field in self.state_fields(state).items():
+            field = np.asarray(field)
+            if not np.isfinite(field).all():
+                problems.append("{} has {} non-finite values".format(name, np.count_nonzero(~np.isfinite(field))))
+            elif name in limits and abs(field).max() > limits[name]:
+                problems.append("max|{}| = {} exceeds {}".format(name, abs(field).max(), limits[name]))
+        return problems
+
+    def save_state(self, filename, **extra):
+        """
+        Write the fields, time, grid, parameters and NumPy RNG state into a compressed .npz checkpoint.
+        Any `extra` values are stored alongside and handed back by `load_state`.
+        """
+        arrays = {'state_{}'.format(i): field.numpy() for i, field in enumerate(tf.nest.flatten(self.state))}
+        _, rng_keys, rng_pos, rng_has_gauss, rng_cached_gaussian = np.random.get_state()
+        arrays.update({'extra_' + key: value for key, value in extra.items()})
+        # Write next to the target and swap it in so that a crash never leaves a truncated checkpoint behind
+        temporary = '{}.tmp'.format(filename)
+        with open(temporary, 'wb') as f:
+            np.savez_compressed(
+                f,
+                t=self._t.numpy(),
+                dt=self.dt,
+                substeps=self.substeps,
+                dx=self.dx,
+                shape=self.shape,
+                params=json.dumps(self.params, sort_keys=True, default=lambda value: np.asarray(value).tolist()),
+                rng_keys=rng_keys,
+                rng_pos=rng_pos,
+                rng_has_gauss=rng_has_gauss,
+                rng_cached_gaussian=rng_cached_gaussian,
+                **arrays
+            )
+        os.replace(temporary, filename)
+
+    def load_state(self, filename):
+        """
+        Restore a checkpoint written by `save_state` into this solver and return the extra values stored with it.
+        The solver must have been set up with the same grid, time step and parameters. A time step that the watchdog
+        refined during the checkpointed run is taken over.
+        """
+        with np.load(filename) as data:
+            substeps = int(data['substeps']) if 'substeps' in data.files else 1
+            if tuple(data['shape']) != self.shape or data['dx'] != self.dx:
+                raise ValueError("Checkpoint grid doesn't match the solver")
+            if not np.isclose(data['dt'] * substeps, self.dt * self.substeps):
+                raise ValueError("Checkpoint time step doesn't match the solver")
+            params = json.dumps(self.params, sort_keys=True, default=lambda value: np.asarray(value).tolist())
+            if str(data['params']) != params:
+                raise ValueError("Checkpoint was made with different parameters")
+
+            fields = tf.nest.flatten(self.state)
+            for i, field in enumerate(fields):
+                if data['state_{}'.format(i)].shape != tuple(field.shape):
+                    raise ValueError("Checkpoint fields don't match the solver's grid and ensemble size")
+            self.state = tf.nest.pack_sequence_as(self.state, [
+                tf.constant(data['state_{}'.format(i)], field.dtype) for i, field in enumerate(fields)
+            ])
+            if data['dt'] != self.dt:
+                self.set_time_step(float(data['dt']))
+            self.substeps = substeps
+            self.t = data['t']
+            np.random.set_state((
+                'MT19937', data['rng_keys'], int(data['rng_pos']), int(data['rng_has_gauss']), float(data['rng_cached_gaussian'])
+            ))
+            return {key[len('extra_'):]: data[key][()] for key in data.files if key.startswith('extra_')}
+
 
 class PDESolverDx(PDESolver):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        omega = self.omega
+        if self.real_fft:
+            # The Nyquist modes of an odd derivative have no Hermitian partner. The complex transform throws them away
+            # when the real part is taken so do the same explicitly for the half-spectrum transform.
+            omega = [o * ~np.isclose(abs(o), np.pi / self.dx) for o in omega]
         if self.dims == 1:
-            self.kernel_dx = tf.constant(1j * self.omega_x, 'complex128')
+            self.kernel_dx = tf.constant(1j * omega[0], self.complex_dtype)
         elif self.dims == 2:
-            self.kernel_dx = tf.constant(1j * self.omega_x, 'complex128')
-            self.kernel_dy = tf.constant(1j * self.omega_y, 'complex128')
+            self.kernel_dx = tf.constant(1j * omega[0], self.complex_dtype)
+            self.kernel_dy = tf.constant(1j * omega[1], self.complex_dtype)
         elif self.dims == 3:
-            self.kernel_dx = tf.constant(1j * self.omega_x, 'complex128')
-            self.kernel_dy = tf.constant(1j * self.omega_y, 'complex128')
-            self.kernel_dz = tf.constant(1j * self.omega_z, 'complex128')
+            self.kernel_dx = tf.constant(1j * omega[0], self.complex_dtype)
+            self.kernel_dy = tf.constant(1j * omega[1], self.complex_dtype)
+            self.kernel_dz = tf.constant(1j * omega[2], self.complex_dtype)
+        self.kernel_gradient = [tf.constant(1j * o, self.complex_dtype) for o in omega]
+
+    def gradient(self, f):
+        """
+        Gradient of the field(s) with spectrum `f` as a single batched inverse transform.
+        Any leading batch axes of `f` are kept and the components are stacked in front of them.
+        """
+        return tf.cast(self.ifft(tf.stack([f * kernel for kernel in self.kernel_gradient])), self.dtype)
+
+    def decay_gradient(self, f, rate):
+        """
+        The field with spectrum `f` damped by `decay(rate(*wave_numbers()))` stacked in front of its gradient, all in
+        one batched inverse transform.
+
+        Rates that are not even in each omega on its own (say omega_x*omega_y) give kernels that take different values
+        at a Nyquist mode and at its mirror image, which the grid stores as the same mode. The full complex transform
+        keeps the Hermitian part of each kernel when the real part is taken. The half-spectrum transform can only
+        represent Hermitian spectra so that part is taken explicitly, for the decay and for each of its products with
+        a derivative.
+        """
+        omega = self.wave_numbers()
+        decay = self.decay(rate(*omega))
+        if not self.real_fft:
+            f *= decay
+            return tf.cast(self.ifft(tf.stack([f] + [f * kernel for kernel in self.kernel_gradient])), self.dtype)
+        # The mode at -omega has the same omegas negated except on the Nyquist planes
+        mirrored = self.wave_numbers(mirrored=True)
+        decay_mirrored = self.decay(rate(*[-o for o in mirrored]))
+        derivative = lambda o: 1j * tf.cast(o, self.complex_dtype)
+        kernels = [(decay + decay_mirrored) / 2] + [
+            (decay * derivative(o) + decay_mirrored * derivative(o_mirrored)) / 2
+            for o, o_mirrored in zip(omega, mirrored)
+        ]
+        return tf.cast(self.ifft(tf.stack([f * kernel for kernel in kernels])), self.dtype)
 
 
 class PDESolverDx2(PDESolverDx):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         if self.dims == 1:
-            self.kernel_laplacian = tf.constant(-self.omega_x**2, 'complex128')
+            self.kernel_laplacian = tf.constant(-self.omega_x**2, self.complex_dtype)
         elif self.dims == 2:
-            self.kernel_laplacian = tf.constant(-(self.omega_x**2 + self.omega_y**2), 'complex128')
+            self.kernel_laplacian = tf.constant(-(self.omega_x**2 + self.omega_y**2), self.complex_dtype)
         elif self.dims == 3:
-            self.kernel_laplacian = tf.constant(-(self.omega_x**2 + self.omega_y**2 + self.omega_z**2), 'complex128')
+            self.kernel_laplacian = tf.constant(-(self.omega_x**2 + self.omega_y**2 + self.omega_z**2), self.complex_dtype)
 
 
 if __name__ == '__main__':
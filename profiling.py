@@ -0,0 +1,99 @@
+import threading
+import time
+from contextlib import contextmanager
+import tensorflow as tf
+
+
+def wait():
+    """
+    Block until the devices have finished the work queued so far
+    """
+    tf.test.experimental.sync_devices()
+
+
+class PhaseProfiler(object):
+    """
+    Wall time and call counts of the phases of a run
+
+    Attached to a solver as its `profiler` it times every `advance`. With `split_phases` the steps run eagerly one
+    phase at a time through the compiled phase functions of the model (`reaction_integrator`, `flow_integrator`, ...)
+    so that each phase is timed on its own. That is slower than the single fused step graph so the shares tell more
+    than the totals. Without it only whole `advance` calls are timed at full speed. The render loop adds its own
+    phases such as fetching fields, the probes and waiting on the video pipeline.
+
+    With a `trace_dir` a TensorFlow profiler trace of the steps from `trace_start` to `trace_start + trace_steps`
+    (rounded out to whole `advance` calls) is written there for TensorBoard.
+    """
+
+    def __init__(self, split_phases=True, trace_dir=None, trace_start=0, trace_steps=10):
+        self.split_phases = split_phases
+        self.trace_dir = trace_dir
+        self.trace_start = trace_start
+        self.trace_stop = trace_start + trace_steps
+        self.tracing = False
+        self.steps = 0
+        self.totals = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.totals[name] = self.totals.get(name, 0.0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time the body of the `with` block as phase `name`
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def call(self, name, function, *args):
+        """
+        Time `function(*args)` as phase `name` including the time for its results to be computed
+        """
+        with self.phase(name):
+            result = function(*args)
+            wait()
+        return result
+
+    def begin(self, n_steps):
+        """
+        Called before taking `n_steps` steps. Starts the trace when they reach into the trace window.
+        """
+        if self.trace_dir and not self.tracing and self.steps + n_steps > self.trace_start and self.steps < self.trace_stop:
+            tf.profiler.experimental.start(self.trace_dir)
+            self.tracing = True
+
+    def end(self, n_steps):
+        """
+        Called after taking `n_steps` steps. Stops the trace at the end of the trace window.
+        """
+        self.steps += n_steps
+        if self.tracing and self.steps >= self.trace_stop:
+            self.stop_trace()
+
+    def stop_trace(self):
+        if self.tracing:
+            tf.profiler.experimental.stop()
+            self.tracing = False
+
+    def summary(self):
+        """
+        Table of the phases with their call counts, total and mean wall time and share of the time spent advancing
+        """
+        reference = self.totals.get('advance') or sum(self.totals.values()) or 1.0
+        lines = [
+            "{} steps{}".format(self.steps, ", phases split" if self.split_phases else ""),
+            "{:<32} {:>9} {:>11} {:>11} {:>8}".format('phase', 'calls', 'total s', 'mean ms', 'share'),
+        ]
+        for name, total in sorted(self.totals.items(), key=lambda item: -item[1]):
+            calls = self.calls[name]
+            lines.append("{:<32} {:>9} {:>11.3f} {:>11.3f} {:>7.1f}%".format(
+                name, calls, total, 1e3 * total / calls, 100 * total / reference
+            ))
+        return '\n'.join(lines)
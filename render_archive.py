@@ -0,0 +1,170 @@
+from __future__ import division
+
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import multiprocessing
+import os
+import numpy as np
+import progressbar
+import tensorflow as tf
+import yaml
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
+from colour_maps import auto_colours, make_colours, needs_ranges
+from colour_ranges import RangeTracker
+from field_archive import FieldArchive
+from render_video import RESOLUTIONS, concatenate_videos, frame_converter, open_writer, write_colour_ranges
+from video_outputs import VideoOutput
+
+
+def render_archive(archive, outfile, colours, args, chunks=None, progress=True):
+    """
+    Map the frames of a field archive (or just its `chunks`) to video without re-running the simulation.
+
+    Whole chunks are colour mapped at once by a pool of `args.workers` threads (the TensorFlow ops underneath run on
+    all cores) while the frames of finished chunks are encoded in order.
+    """
+    shape = archive.metadata['shape']
+    video_shape = (args.video_width, args.video_height) if args.video_width else shape[:2]
+    to_frames = frame_converter([VideoOutput(outfile, colours)], len(shape), shape, video_shape, args.upsampling)
+
+    def convert(filename):
+        return to_frames(archive.load_chunk(filename))[0]
+
+    chunks = archive.chunks if chunks is None else chunks
+    writer = open_writer(outfile, args)
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            pending = deque()
+            remaining = iter(chunks)
+            bar = progressbar.ProgressBar(max_value=len(chunks)) if progress else None
+            done = 0
+            while True:
+                while len(pending) < 2 * args.workers:
+                    filename = next(remaining, None)
+                    if filename is None:
+                        break
+                    pending.append(executor.submit(convert, filename))
+                if not pending:
+                    break
+                for frame in pending.popleft().result():
+                    writer.append_data(frame)
+                done += 1
+                if bar:
+                    bar.update(done)
+            if bar:
+                bar.finish()
+    finally:
+        writer.close()
+
+
+def set_threads(threads):
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(threads)
+
+
+def render_segment(path, chunks, outfile, config, args):
+    render_archive(FieldArchive(path), outfile, make_colours(config), args, chunks=chunks, progress=False)
+    return outfile
+
+
+def render_archive_parallel(archive, outfile, config, args):
+    """
+    Split the archive into `args.encoders` runs of consecutive chunks, render them into separate segment files in
+    as many worker processes and join the segments without re-encoding them. There are never more workers than cores.
+
+    The cores are shared out evenly between the workers for both TensorFlow and (with the ffmpeg writer) encoding.
+    """
+    encoders = min(args.encoders, len(archive.chunks), os.cpu_count())
+    if encoders < 2:
+        render_archive(archive, outfile, make_colours(config), args)
+        return
+    threads = max(1, os.cpu_count() // encoders)
+    if args.video_writer == 'ffmpeg' and not args.encoder_threads:
+        args.encoder_threads = threads
+    args.workers = min(args.workers, threads)
+
+    root, ext = os.path.splitext(outfile)
+    boundaries = np.linspace(0, len(archive.chunks), encoders + 1).round().astype(int)
+    segments = ['{}.part{:03d}{}'.format(root, i, ext) for i in range(encoders)]
+
+    # Spawn fresh workers rather than forking a process that has already started up TensorFlow
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=encoders, mp_context=context, initializer=set_threads, initargs=(threads,)) as executor:
+        futures = [
+            executor.submit(render_segment, archive.path, archive.chunks[start:end], segment, config, args)
+            for start, end, segment in zip(boundaries[:-1], boundaries[1:], segments)
+        ]
+        for future in progressbar.progressbar(as_completed(futures), max_value=len(futures)):
+            future.result()
+
+    concatenate_videos(segments, outfile)
+    for segment in segments:
+        os.remove(segment)
+
+
+def calibrate(archive, fields):
+    """
+    Track the ranges of the archived `fields` over the whole archive
+    """
+    tracker = RangeTracker(fields)
+    for filename in progressbar.progressbar(archive.chunks):
+        tracker.update(archive.load_chunk(filename))
+    return tracker
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render a video from a field archive recorded by render_video.py --archive')
+    parser.add_argument('archive', type=str, help='Archive directory')
+    parser.add_argument('outfile', type=str, help='Output file name')
+    parser.add_argument('--colours', type=str, help='Colour config YAML file. A parameter file with a colours entry works too.')
+    parser.add_argument('--auto-colours', action='store_true', help='Set the colour channel ranges from quantiles over the whole archive')
+    parser.add_argument('--colour-ranges', type=str, help='Write the ranges in the archive and a matching colour config into this YAML file', metavar='FILE')
+    parser.add_argument('--video-resolution', choices=RESOLUTIONS.keys(), help='Video resolution (defaults to the simulation grid)')
+    parser.add_argument('--upsampling', choices=['spectral', 'bicubic'], default='spectral', help='Resampling method from the simulation grid to the video')
+    parser.add_argument('--framerate', type=int, help='Video frame rate (defaults to that of the simulation run)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of colour mapping threads')
+    parser.add_argument('--encoders', type=int, default=1, help='Split the video into this many segments encoded in parallel processes', metavar='N')
+    parser.add_argument('--video-quality', type=int, default=10, help='Video quality factor')
+    parser.add_argument('--video-writer', choices=['imageio', 'ffmpeg'], default='imageio', help='Encode through imageio or pipe raw frames straight into ffmpeg')
+    parser.add_argument('--preset', type=str, default='medium', help='ffmpeg encoder preset (ultrafast ... veryslow)')
+    parser.add_argument('--crf', type=int, default=18, help='ffmpeg constant rate factor. Lower is better quality')
+    parser.add_argument('--lossless', action='store_true', help='Encode losslessly with ffmpeg')
+    parser.add_argument('--encoder-threads', type=int, default=0, help='Number of ffmpeg encoder threads (0 for automatic)', metavar='N')
+    parser.add_argument('--pixel-format', type=str, help='ffmpeg output pixel format')
+    args = parser.parse_args()
+
+    archive = FieldArchive(args.archive)
+    if len(archive.metadata['shape']) != 2:
+        # The colours of 3D episodes are projections and particle streaks made during the run, not maps of the fields
+        raise ValueError("Only archives of 2D episodes can be rendered. '{}' holds a {}D '{}' run.".format(
+            args.archive, len(archive.metadata['shape']), archive.metadata.get('episode')
+        ))
+    args.video_width, args.video_height = RESOLUTIONS[args.video_resolution] if args.video_resolution else (None, None)
+    if not args.framerate:
+        args.framerate = archive.metadata.get('framerate', 24)
+
+    config = None
+    if args.colours:
+        with open(args.colours) as f:
+            config = yaml.load(f, Loader=Loader)
+        config = config.get('colours', config)
+    if args.auto_colours:
+        config = auto_colours(config)
+
+    if args.colour_ranges or needs_ranges(config):
+        # Unlike a live render the whole run is known up front so the ranges are fixed before rendering
+        print("Calibrating colour ranges")
+        tracker = calibrate(archive, [name for name in 'GXY' if name in archive.fields])
+        if args.colour_ranges:
+            write_colour_ranges(args.colour_ranges, tracker, config)
+        config = tracker.colour_config(config)
+
+    if args.encoders > 1:
+        render_archive_parallel(archive, args.outfile, config, args)
+    else:
+        render_archive(archive, args.outfile, make_colours(config), args)
@@ -0,0 +1,253 @@
+from __future__ import division
+
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import contextlib
+import glob
+import itertools
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+import traceback
+import yaml
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    name TEXT PRIMARY KEY,
+    params TEXT NOT NULL,
+    outfile TEXT NOT NULL,
+    render_args TEXT NOT NULL DEFAULT '[]',
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    started REAL,
+    finished REAL,
+    error TEXT
+)
+"""
+
+
+class JobTable(object):
+    """
+    Render jobs and their progress in a SQLite database
+
+    A job is 'pending', 'running', 'done' or 'failed'. Jobs are keyed by name. Adding a job that is already in the
+    table only resets it when its parameters or the arguments passed on to render_video.py have changed or its video
+    has gone missing, so running a batch again picks up where it left off. Jobs still marked running belonged to a
+    batch that died and go back to pending.
+    """
+
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename)
+        with self.connection:
+            self.connection.execute(SCHEMA)
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(jobs)")]
+            if 'render_args' not in columns:
+                # Tables from before the render arguments were part of a job
+                self.connection.execute("ALTER TABLE jobs ADD COLUMN render_args TEXT NOT NULL DEFAULT '[]'")
+            self.connection.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'")
+
+    def add(self, name, params, outfile, render_args=()):
+        params = yaml.dump(params, sort_keys=True)
+        render_args = json.dumps(list(render_args))
+        row = self.connection.execute(
+            "SELECT params, outfile, render_args, status FROM jobs WHERE name = ?", (name,)
+        ).fetchone()
+        with self.connection:
+            if row is None:
+                self.connection.execute(
+                    "INSERT INTO jobs (name, params, outfile, render_args) VALUES (?, ?, ?, ?)",
+                    (name, params, outfile, render_args)
+                )
+            elif (row[0], row[1], row[2]) != (params, outfile, render_args) or (row[3] == 'done' and not os.path.exists(outfile)):
+                self.connection.execute(
+                    "UPDATE jobs SET params = ?, outfile = ?, render_args = ?, status = 'pending', error = NULL WHERE name = ?",
+                    (params, outfile, render_args, name)
+                )
+
+    def pending(self, retry_failed=False):
+        statuses = ('pending', 'failed') if retry_failed else ('pending',)
+        rows = self.connection.execute(
+            "SELECT name, params, outfile FROM jobs WHERE status IN ({}) ORDER BY rowid".format(','.join('?' * len(statuses))),
+            statuses
+        )
+        return [(name, yaml.load(params, Loader=Loader), outfile) for name, params, outfile in rows]
+
+    def start(self, name):
+        with self.connection:
+            self.connection.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, started = ?, error = NULL WHERE name = ?",
+                (time.time(), name)
+            )
+
+    def finish(self, name, error=None):
+        with self.connection:
+            self.connection.execute(
+                "UPDATE jobs SET status = ?, finished = ?, error = ? WHERE name = ?",
+                ('failed' if error else 'done', time.time(), error, name)
+            )
+
+    def counts(self):
+        return dict(self.connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+
+    def close(self):
+        self.connection.close()
+
+
+def set_nested(params, key, value):
+    """
+    Set a dotted `key` such as 'model_params.viscosity' in the nested dict `params`
+    """
+    *path, last = key.split('.')
+    for part in path:
+        params = params.setdefault(part, {})
+    params[last] = value
+
+
+def sweep_jobs(filename):
+    """
+    Jobs for every combination of the values of a sweep spec, a YAML file like
+
+        params: params/nucleation_and_motion_in_fluid_2D.yaml
+        name: viscosity  # prefix of the job names, defaults to the name of the parameter file
+        sweep:
+            model_params.viscosity: [0.3, 0.4, 0.5]
+            oversampling: [2, 4]
+    """
+    with open(filename) as f:
+        spec = yaml.load(f, Loader=Loader)
+    with open(spec['params']) as f:
+        base = yaml.load(f, Loader=Loader)
+    prefix = spec.get('name', os.path.splitext(os.path.basename(spec['params']))[0])
+    keys = list(spec['sweep'])
+    for values in itertools.product(*(spec['sweep'][key] for key in keys)):
+        params = yaml.load(yaml.dump(base), Loader=Loader)
+        for key, value in zip(keys, values):
+            set_nested(params, key, value)
+        name = '_'.join([prefix] + ['{}={}'.format(key.split('.')[-1], value) for key, value in zip(keys, values)])
+        yield name, params
+
+
+def file_jobs(patterns):
+    for pattern in patterns:
+        for filename in sorted(glob.glob(pattern)) or [pattern]:
+            with open(filename) as f:
+                yield os.path.splitext(os.path.basename(filename))[0], yaml.load(f, Loader=Loader)
+
+
+def set_threads(threads):
+    # Imported here so that the batch process itself never starts up TensorFlow
+    from render_archive import set_threads
+    set_threads(threads)
+
+
+def run_job(params, outfile, render_args):
+    """
+    Render a single job in a worker process. The parameters are written next to the video and the output of the
+    render goes to a log file there too.
+    """
+    import render_video
+
+    root = os.path.splitext(outfile)[0]
+    params_filename = root + '.yaml'
+    with open(params_filename, 'w') as f:
+        yaml.dump(params, f, sort_keys=False)
+    start = time.time()
+    with open(root + '.log', 'a') as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            render_video.main([outfile, '--params', params_filename] + render_args)
+        except Exception:
+            traceback.print_exc()
+            raise
+    return time.time() - start
+
+
+def run_batch(jobs, table, args, render_args):
+    """
+    Run the pending jobs of `table` in a pool of `args.workers` processes with `args.threads` TensorFlow threads each.
+    Every job gets a fresh process so that nothing built for one render stays around for the next. No more jobs are
+    handed to the pool than it has workers so that a job is only marked running once it is.
+    """
+    for name, params, outfile in jobs:
+        table.add(name, params, outfile, render_args)
+    names = set(name for name, _, _ in jobs)
+    pending = [job for job in table.pending(args.retry_failed) if job[0] in names]
+    skipped = len(jobs) - len(pending)
+    print("{} jobs to render, {} skipped, {} workers with {} threads each".format(len(pending), skipped, args.workers, args.threads))
+    if not pending:
+        return
+
+    if args.checkpoint_interval:
+        # A job cut short by a crash carries on from its last checkpoint
+        render_args = render_args + ['--checkpoint-interval', str(args.checkpoint_interval), '--resume']
+
+    # Spawn fresh workers rather than forking a process that may have started up TensorFlow
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(
+        max_workers=args.workers,
+        mp_context=context,
+        initializer=set_threads,
+        initargs=(args.threads,),
+        max_tasks_per_child=1
+    ) as executor:
+        futures = {}
+        queue = list(pending)
+        while queue or futures:
+            while queue and len(futures) < args.workers:
+                name, params, outfile = queue.pop(0)
+                table.start(name)
+                futures[executor.submit(run_job, params, outfile, render_args)] = name
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = futures.pop(future)
+                try:
+                    elapsed = future.result()
+                except Exception as error:
+                    table.finish(name, '{}: {}'.format(type(error).__name__, error))
+                    print("Failed {}: {}".format(name, error))
+                else:
+                    table.finish(name)
+                    print("Done {} in {:.1f} s".format(name, elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Render batches of parameter files. Arguments after -- go to every render_video.py run.'
+    )
+    parser.add_argument('params', type=str, nargs='*', help='Parameter YAML files or glob patterns')
+    parser.add_argument('--sweep', type=str, help='Render every combination of the parameter values in this sweep spec YAML file', metavar='FILE')
+    parser.add_argument('--outdir', type=str, default='renders', help='Directory for the videos, logs and job table')
+    parser.add_argument('--format', type=str, default='mp4', help='Video file extension')
+    parser.add_argument('--db', type=str, help='Job table SQLite file (defaults to jobs.sqlite in the output directory)')
+    parser.add_argument('--workers', type=int, default=1, help='Number of renders running at once', metavar='N')
+    parser.add_argument('--threads', type=int, help='TensorFlow threads per render (defaults to sharing the cores evenly)', metavar='N')
+    parser.add_argument('--checkpoint-interval', type=int, help='Checkpoint every N frames so that crashed renders resume', metavar='N')
+    parser.add_argument('--retry-failed', action='store_true', help='Render failed jobs again')
+    argv = sys.argv[1:]
+    render_args = argv[argv.index('--') + 1:] if '--' in argv else []
+    args = parser.parse_args(argv[:argv.index('--')] if '--' in argv else argv)
+
+    if not args.params and not args.sweep:
+        raise ValueError("Nothing to render. Give parameter files or a sweep spec.")
+    if not args.threads:
+        args.threads = max(1, os.cpu_count() // args.workers)
+    os.makedirs(args.outdir, exist_ok=True)
+
+    jobs = list(file_jobs(args.params))
+    if args.sweep:
+        jobs += list(sweep_jobs(args.sweep))
+    jobs = [(name, params, os.path.join(args.outdir, '{}.{}'.format(name, args.format))) for name, params in jobs]
+
+    table = JobTable(args.db or os.path.join(args.outdir, 'jobs.sqlite'))
+    try:
+        run_batch(jobs, table, args, render_args)
+        print("Jobs: {}".format(', '.join('{} {}'.format(count, status) for status, count in sorted(table.counts().items()))))
+    finally:
+        table.close()
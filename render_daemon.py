@@ -0,0 +1,215 @@
+from __future__ import division
+
+import argparse
+from collections import OrderedDict
+import contextlib
+import json
+import os
+import socket
+import socketserver
+import sys
+import time
+import traceback
+import numpy as np
+
+
+DEFAULT_SOCKET = '/tmp/tf2-model-g-render.sock'
+
+
+class GraphCache(object):
+    """
+    Compiled integrators of the models rendered so far
+
+    The step graphs only capture the kernels, parameters, time step and source profiles of a model. Models of the
+    same episode on the same grid with the same dtype, time step and parameters can therefore share them and skip
+    tracing and XLA compilation altogether.
+
+    The integrators are closures over the model they were compiled for, so every entry keeps that whole model alive
+    including its fields. Only the `max_entries` most recently used entries are kept.
+    """
+
+    def __init__(self, max_entries=4):
+        self.integrators = OrderedDict()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, episode, model):
+        params = json.dumps(model.params, sort_keys=True, default=lambda value: np.asarray(value).tolist())
+        dtype = '{}/{}'.format(model.dtype.name, model.reaction_dtype.name)
+        return (episode, type(model).__name__, model.shape, model.batch_size, model.dx, model.dt, dtype, params)
+
+    def adopt(self, episode, model):
+        """
+        Hand `model` the integrators compiled for an equivalent model or remember its own for later ones.
+        Returns whether there was a hit.
+        """
+        key = self.key(episode, model)
+        if key in self.integrators:
+            self.integrators.move_to_end(key)
+            model.step_integrator, model.advance_integrator, model.guarded_advance_integrator = self.integrators[key]
+            self.hits += 1
+            return True
+        self.integrators[key] = (model.step_integrator, model.advance_integrator, model.guarded_advance_integrator)
+        while len(self.integrators) > self.max_entries:
+            self.integrators.popitem(last=False)
+            self.evictions += 1
+        self.misses += 1
+        return False
+
+    def summary(self):
+        return {
+            'graphs': [
+                {'episode': key[0], 'model': key[1], 'shape': list(key[2]), 'batch_size': key[3], 'dt': key[5], 'dtype': key[6]}
+                for key in self.integrators
+            ],
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'max_entries': self.max_entries,
+        }
+
+
+def send(connection, message):
+    connection.sendall((json.dumps(message) + '\n').encode())
+
+
+class ConnectionWriter(object):
+    """
+    File-like object forwarding the output of a render to the client that submitted it. There is only one for the
+    life of the daemon because libraries such as progressbar hold on to the stream they first saw. Output between
+    jobs goes nowhere.
+    """
+
+    def __init__(self):
+        self.connection = None
+
+    def write(self, text):
+        if text and self.connection is not None:
+            send(self.connection, {'output': text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class RenderHandler(socketserver.StreamRequestHandler):
+    """
+    Serves a single request. Requests are JSON lines with a `command` of 'render' (with the `argv` of
+    render_video.py and the `cwd` to run it in), 'status' or 'shutdown'. The render output is streamed back as
+    `output` messages followed by a final message with the `status`.
+    """
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        try:
+            if request['command'] == 'render':
+                self.server.output.connection = self.connection
+                try:
+                    reply = self.server.render(request)
+                finally:
+                    self.server.output.connection = None
+                send(self.connection, reply)
+            elif request['command'] == 'status':
+                send(self.connection, dict(self.server.graph_cache.summary(), status='ok', jobs=self.server.jobs))
+            elif request['command'] == 'shutdown':
+                send(self.connection, {'status': 'ok'})
+                self.server.running = False
+            else:
+                send(self.connection, {'status': 'failed', 'error': "Unknown command {}".format(request['command'])})
+        except OSError:
+            # The client hung up
+            pass
+
+
+class RenderServer(socketserver.UnixStreamServer):
+    """
+    Render daemon keeping TensorFlow loaded and the compiled integrators of earlier jobs around.
+    Jobs run one at a time each using all of the TensorFlow threads.
+    """
+
+    def __init__(self, path, max_graphs=4):
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, RenderHandler)
+        self.graph_cache = GraphCache(max_graphs)
+        self.output = ConnectionWriter()
+        self.jobs = 0
+        self.running = True
+
+    def render(self, request):
+        import render_video
+
+        start = time.time()
+        hits = self.graph_cache.hits
+        cwd = os.getcwd()
+        try:
+            os.chdir(request.get('cwd', cwd))
+            with contextlib.redirect_stdout(self.output), contextlib.redirect_stderr(self.output):
+                render_video.main(request['argv'], graph_cache=self.graph_cache)
+        except (Exception, SystemExit) as error:
+            with contextlib.redirect_stderr(self.output):
+                traceback.print_exc()
+            return {'status': 'failed', 'error': '{}: {}'.format(type(error).__name__, error)}
+        finally:
+            os.chdir(cwd)
+            self.jobs += 1
+        return {'status': 'done', 'elapsed': time.time() - start, 'cached': self.graph_cache.hits > hits}
+
+    def serve(self):
+        while self.running:
+            self.handle_request()
+        self.server_close()
+        os.remove(self.server_address)
+
+
+def request(path, message):
+    """
+    Send `message` to the daemon at `path` printing any output on the way and return the final reply
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(path)
+        send(connection, message)
+        for line in connection.makefile('r'):
+            reply = json.loads(line)
+            if 'output' in reply:
+                sys.stderr.write(reply['output'])
+                sys.stderr.flush()
+            else:
+                return reply
+    raise RuntimeError("The render daemon hung up")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Warm render daemon. `serve` starts it. `render` takes the arguments of render_video.py and runs '
+                    'them in the daemon.'
+    )
+    parser.add_argument('command', choices=['serve', 'render', 'status', 'shutdown'])
+    parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET, help='Unix socket of the daemon')
+    parser.add_argument('--threads', type=int, help='TensorFlow threads of the daemon (defaults to all cores)', metavar='N')
+    parser.add_argument('--max-graphs', type=int, default=4, help='Compiled models to keep. Each one holds on to the fields of the model it was compiled for.', metavar='N')
+    args, render_args = parser.parse_known_args()
+
+    if args.command == 'serve':
+        if render_args:
+            parser.error("unrecognized arguments: {}".format(' '.join(render_args)))
+        if args.threads:
+            from render_archive import set_threads
+            set_threads(args.threads)
+        # Pay for starting up TensorFlow before taking any jobs
+        import render_video
+        server = RenderServer(args.socket, args.max_graphs)
+        print("Rendering jobs sent to {}".format(args.socket))
+        server.serve()
+    elif args.command == 'render':
+        reply = request(args.socket, {'command': 'render', 'argv': render_args, 'cwd': os.getcwd()})
+        if reply['status'] != 'done':
+            sys.exit(reply['error'])
+        print("Done in {:.2f} s{}".format(reply['elapsed'], ' with cached graphs' if reply['cached'] else ''))
+    else:
+        print(json.dumps(request(args.socket, {'command': args.command}), indent=2))
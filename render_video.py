@@ -1,19 +1,34 @@
 from __future__ import division
 
 import argparse
+import contextlib
+import os
+import subprocess
 import numpy as np
 import tensorflow as tf
 import progressbar
 import imageio
+import imageio_ffmpeg
 import yaml
 try:
     from yaml import CLoader as Loader
 except ImportError:
     from yaml import Loader
 
+from colour_maps import auto_colours, colour_fields, make_colours, ranged_fields
+from colour_ranges import RangeTracker
+from ffmpeg_writer import FFmpegWriter
+from field_archive import FieldArchiveWriter
+from frame_pipeline import FramePipeline
 from model_g import ModelG
 from fluid_model_g import FluidModelG
+from pde_solver import Watchdog
+from profiling import PhaseProfiler
+from sources import Source, gaussian_pulse, tanh_switch
+from tracer import ParticleTracer
+from upsampling import Upsampler
 from util import bl_noise
+from video_outputs import FlowSpeed, MultiWriter, make_outputs
 
 
 RESOLUTIONS = {
@@ -30,27 +45,253 @@ RESOLUTIONS = {
 }
 
 
-def make_video_frame(rgb, indexing='ij'):
+def video_frame(rgb, indexing='ij'):
+    """
+    Turn [red, green, blue] channels into uint8 video frame tensor(s). Leading axes of the channels are kept as is.
+    """
     if indexing == 'ij':
-        rgb = [tf.transpose(channel) for channel in rgb]
+        rgb = [tf.linalg.matrix_transpose(channel) for channel in rgb]
     frame = tf.stack(rgb, axis=-1)
     frame = tf.clip_by_value(frame, 0.0, 1.0)
-    return tf.cast(frame * 255, 'uint8').numpy()
+    return tf.cast(frame * 255, 'uint8')
+
+
+def make_video_frame(rgb, indexing='ij'):
+    return video_frame(rgb, indexing).numpy()
+
+
+def open_writer(filename, args):
+    if args.video_writer == 'ffmpeg':
+        return FFmpegWriter(
+            filename,
+            fps=args.framerate,
+            preset=args.preset,
+            crf=args.crf,
+            lossless=args.lossless,
+            threads=args.encoder_threads,
+            pixel_format=args.pixel_format
+        )
+    return imageio.get_writer(filename, fps=args.framerate, quality=args.video_quality, macro_block_size=1)
+
+
+def concatenate_videos(filenames, outfile):
+    """
+    Join video files with identical encoding settings without re-encoding them
+    """
+    listing = '{}.txt'.format(outfile)
+    with open(listing, 'w') as f:
+        for filename in filenames:
+            f.write("file '{}'\n".format(os.path.abspath(filename)))
+    subprocess.run(
+        [imageio_ffmpeg.get_ffmpeg_exe(), '-y', '-v', 'warning', '-f', 'concat', '-safe', '0', '-i', listing, '-c', 'copy', outfile],
+        check=True
+    )
+    os.remove(listing)
+
+
+def checkpoint_filename(args):
+    return '{}.checkpoint.npz'.format(args.outfile)
+
+
+def probe_states(probes):
+    """
+    Checkpoint extras holding the state of the probes that keep one across frames (those with `checkpoint_state`)
+    """
+    extra = {}
+    for index, probe in enumerate(probes):
+        if hasattr(probe, 'checkpoint_state'):
+            for key, value in probe.checkpoint_state().items():
+                extra['probe{}_{}'.format(index, key)] = value
+    return extra
+
+
+def restore_probes(probes, extra):
+    """
+    Hand the probes back their state from the checkpoint `extra` values written with `probe_states`
+    """
+    for index, probe in enumerate(probes):
+        prefix = 'probe{}_'.format(index)
+        state = {key[len(prefix):]: value for key, value in extra.items() if key.startswith(prefix)}
+        if state:
+            probe.restore_state(state)
+
+
+def segment_filename(outfile, index):
+    root, ext = os.path.splitext(outfile)
+    return '{}.part{:03d}{}'.format(root, index, ext)
+
+
+def open_archive(args, model, start_frame):
+    fields = ['G', 'X', 'Y']
+    if args.archive_flow:
+        fields += list('uvw'[:model.dims])
+    return FieldArchiveWriter(
+        args.archive,
+        fields=fields,
+        frames_per_chunk=args.archive_chunk,
+        start_frame=start_frame,
+        metadata={
+            'episode': args.episode,
+            'framerate': args.framerate,
+            'dx': model.dx,
+            'dt': model.dt * args.oversampling,
+            'shape': list(model.shape),
+        }
+    )
 
 
-def nucleation_and_motion_in_G_gradient_fluid_2D(writer, args, R=16):
+def write_colour_ranges(filename, tracker, config):
+    with open(filename, 'w') as f:
+        yaml.dump({'colours': tracker.colour_config(auto_colours(config)), 'ranges': tracker.summary()}, f, sort_keys=False)
+
+
+def frame_converter(outputs, dims, sim_shape, video_shape, method='spectral'):
+    """
+    Function turning the fields of a frame into a list with a video frame for each of the `outputs`. The colours of
+    all outputs are computed in a single graph call.
+
+    When the video size differs from the simulation grid 2D fields are resampled before colour mapping. The colour
+    channels of 3D episodes are already projections so those are resampled instead (unless they show another plane).
+    """
+    sim_shape = tuple(sim_shape[:2])
+    video_shape = tuple(video_shape)
+    upsampler = None if video_shape == sim_shape else Upsampler(sim_shape, video_shape, method)
+
+    def output_frame(output, fields):
+        rgb = output.colours(output.view(fields, dims))
+        if upsampler and dims > 2:
+            rgb = [upsampler(channel) if tuple(channel.shape[-2:]) == sim_shape else channel for channel in rgb]
+        return video_frame(rgb)
+
+    @tf.function
+    def frames(fields):
+        if upsampler and dims == 2:
+            fields = upsampler.fields(fields)
+        return [output_frame(output, fields) for output in outputs]
+
+    return lambda fields: [frame.numpy() for frame in frames(fields)]
+
+
+def render(args, model, outputs, probes=()):
+    """
+    Advance `model` one video frame at a time and write out the frames of each of the `outputs` (see
+    `video_outputs.VideoOutput`) from the same pass. Colour mapping and encoding run in a pipeline next to the
+    simulation (see `FramePipeline`).
+    With `--archive` the fields are also recorded so that the video can be re-rendered with `render_archive.py`.
+    Every frame each of the `probes` (say a `RangeTracker` or a `ParticleTracer`) looks at the fields and hands its
+    results to the colours as extra fields.
+
+    With a checkpoint interval the video is written in segments. Every interval the current segment is closed and
+    the simulation state saved together with the state of the probes so that `--resume` can carry on with both the
+    simulation and the video.
+
+    With watchdog settings (see `pde_solver.Watchdog`) the fields are watched for blow-ups during the run so that a
+    diverging simulation stops right away instead of rendering the rest of the video out of NaNs.
+
+    When the model has a profiler the render loop times its own phases with it too.
+    """
+    num_video_frames = args.num_frames // args.oversampling
+    if args.watchdog:
+        model.watchdog = Watchdog(**args.watchdog)
+    convert = frame_converter(
+        outputs, model.dims, (args.width, args.height), (args.video_width, args.video_height), args.upsampling
+    )
+    profiler = model.profiler
+    timed = profiler.phase if profiler else lambda name: contextlib.nullcontext()
+    if profiler:
+        # Colour mapping and copying the frames over to the host. Runs next to the simulation.
+        untimed_convert = convert
+        convert = lambda fields: profiler.call('frames', untimed_convert, fields)
+
+    def open_pipeline(segment=None):
+        if args.archive_only:
+            return None
+        filenames = [
+            output.filename if segment is None else segment_filename(output.filename, segment)
+            for output in outputs
+        ]
+        return FramePipeline(
+            MultiWriter([open_writer(filename, args) for filename in filenames]),
+            convert,
+            workers=args.pipeline_workers,
+            max_pending=2 * args.pipeline_workers
+        )
+
+    frame = 0
+    segment = 0
+    if args.checkpoint_interval:
+        if args.resume and os.path.exists(checkpoint_filename(args)):
+            extra = model.load_state(checkpoint_filename(args))
+            frame = int(extra['frame'])
+            segment = int(extra['segment'])
+            restore_probes(probes, extra)
+            print("Resuming from frame {} at t = {}".format(frame, model.t))
+
+        # Segments from an interrupted run past the checkpoint are incomplete
+        for output in outputs:
+            index = segment
+            while os.path.exists(segment_filename(output.filename, index)):
+                os.remove(segment_filename(output.filename, index))
+                index += 1
+        pipeline = open_pipeline(segment)
+    else:
+        pipeline = open_pipeline()
+    archive = open_archive(args, model, frame) if args.archive else None
+
+    try:
+        for n in progressbar.progressbar(range(frame, num_video_frames)):
+            model.advance(args.oversampling)
+            with timed('fields'):
+                fields = model.fields()
+            with timed('probes'):
+                for probe in probes:
+                    fields.update(probe.update(fields))
+            if pipeline:
+                # Waits while the pipeline is full
+                with timed('pipeline'):
+                    pipeline.submit(fields)
+            if archive:
+                with timed('archive'):
+                    archive.submit(model.t, fields)
+            if args.checkpoint_interval and (n + 1) % args.checkpoint_interval == 0 and n + 1 < num_video_frames:
+                with timed('checkpoint'):
+                    if pipeline:
+                        pipeline.close()
+                    if archive:
+                        archive.flush()
+                    segment += 1
+                    model.save_state(checkpoint_filename(args), frame=n + 1, segment=segment, **probe_states(probes))
+                    pipeline = open_pipeline(segment)
+    finally:
+        if pipeline:
+            pipeline.close()
+        if archive:
+            archive.close()
+
+    if not args.checkpoint_interval:
+        return
+    leftovers = [checkpoint_filename(args)]
+    for output in outputs:
+        segments = [segment_filename(output.filename, index) for index in range(segment + 1)]
+        if not args.archive_only:
+            concatenate_videos(segments, output.filename)
+        leftovers += segments
+    for filename in leftovers:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+colours_2D = make_colours()
+
+
+def nucleation_and_motion_in_G_gradient_fluid_2D(args, R=16):
     dx = 2*R / args.height
     x = (np.arange(args.width) - args.width // 2) * dx
     y = (np.arange(args.height) - args.height // 2) * dx
     x, y = np.meshgrid(x, y, indexing='ij')
 
-    def source_G(t):
-        center = np.exp(-0.5*(t-5)**2) * 10
-        gradient = (1+np.tanh(t-30)) * 0.0003
-        return -np.exp(-0.5*(x*x+y*y))* center + (x+8) * gradient
-
     source_functions = {
-        'G': source_G,
+        'G': Source(-np.exp(-0.5*(x*x+y*y)), gaussian_pulse(5, 10)) + Source(x+8, tanh_switch(30, 0.0003)),
     }
 
     flow = [0*x, 0*x]
@@ -64,56 +305,32 @@ def nucleation_and_motion_in_G_gradient_fluid_2D(writer, args, R=16):
         dt=args.dt,
         params=args.model_params,
         source_functions=source_functions,
+        dtype=args.dtype,
+        reaction_dtype=args.reaction_dtype,
     )
 
     print("Rendering 'Nucleation and Motion in G gradient in 2D'")
     print("Lattice constant dx = {}, time step dt = {}".format(fluid_model_g.dx, fluid_model_g.dt))
-    min_G = -4.672736908320116
-    max_G = 0.028719261862332906
-    min_X = -3.8935243721220334
-    max_X = 1.2854028081816122
-    min_Y = -0.7454193158963579
-    max_Y = 4.20524950766914
-    for n in progressbar.progressbar(range(args.num_frames)):
-        fluid_model_g.step()
-        if n % args.oversampling == 0:
-            rgb = [
-                6*(-fluid_model_g.G + max_G) / (max_G - min_G),
-                5*(fluid_model_g.Y - min_Y) / (max_Y - min_Y),
-                0.7*(fluid_model_g.X - min_X) / (max_X - min_X),
-            ]
-            zero_line = 1 - tf.exp(-600 * fluid_model_g.Y**2)
-            frame = make_video_frame([c * zero_line for c in rgb])
-            writer.append_data(frame)
-    #     max_G = max(max_G, tf.reduce_max(fluid_model_g.G).numpy())
-    #     min_G = min(min_G, tf.reduce_min(fluid_model_g.G).numpy())
-    #     max_X = max(max_X, tf.reduce_max(fluid_model_g.X).numpy())
-    #     min_X = min(min_X, tf.reduce_min(fluid_model_g.X).numpy())
-    #     max_Y = max(max_Y, tf.reduce_max(fluid_model_g.Y).numpy())
-    #     min_Y = min(min_Y, tf.reduce_min(fluid_model_g.Y).numpy())
-
-    # print(min_G, max_G, min_X, max_X, min_Y, max_Y)
-
-
-def charged_nucleation_in_2D(writer, args, R=30, D=25, weights=(0, -10, -8, 8)):
+    return fluid_model_g, colours_2D
+
+
+def charged_nucleation_in_2D(args, R=30, D=25, weights=(0, -10, -8, 8)):
     dx = 2*R / args.height
     x = (np.arange(args.width) - args.width // 2) * dx
     y = (np.arange(args.height) - args.height // 2) * dx
     x, y = np.meshgrid(x, y, indexing='ij')
 
-    def source_G(t):
-        amount = np.exp(-0.5*(t-5)**2)
-        return (
-            np.exp(-0.5*((x-D)**2+y*y)) * weights[0] +
-            np.exp(-0.5*((x+D)**2+y*y)) * weights[1]
-        ) * amount
-
-    def source_X(t):
-        amount = np.exp(-0.5*(t-5)**2)
-        return (
-            np.exp(-0.5*((x-D)**2+y*y)) * weights[2] +
-            np.exp(-0.5*((x+D)**2+y*y)) * weights[3]
-        ) * amount
+    amount = gaussian_pulse(5)
+    source_G = Source(
+        np.exp(-0.5*((x-D)**2+y*y)) * weights[0] +
+        np.exp(-0.5*((x+D)**2+y*y)) * weights[1],
+        amount
+    )
+    source_X = Source(
+        np.exp(-0.5*((x-D)**2+y*y)) * weights[2] +
+        np.exp(-0.5*((x+D)**2+y*y)) * weights[3],
+        amount
+    )
 
     source_functions = {
         'G': source_G,
@@ -129,32 +346,16 @@ def charged_nucleation_in_2D(writer, args, R=30, D=25, weights=(0, -10, -8, 8)):
         dt=args.dt,
         params=args.model_params,
         source_functions=source_functions,
+        dtype=args.dtype,
+        reaction_dtype=args.reaction_dtype,
     )
 
     print("Rendering 'Charged nucleation in 2D'")
     print("Lattice constant dx = {}, time step dt = {}".format(model_g.dx, model_g.dt))
-    min_G = -4.672736908320116
-    max_G = 0.028719261862332906
-    min_X = -3.8935243721220334
-    max_X = 1.2854028081816122
-    min_Y = -0.7454193158963579
-    max_Y = 4.20524950766914
-    for n in progressbar.progressbar(range(args.num_frames)):
-        model_g.step()
-        if n % args.oversampling == 0:
-            rgb = [
-                6*(-model_g.G + max_G) / (max_G - min_G),
-                5*(model_g.Y - min_Y) / (max_Y - min_Y),
-                0.7*(model_g.X - min_X) / (max_X - min_X),
-            ]
-            zero_line = 1 - tf.exp(-600 * model_g.Y**2)
-            frame = make_video_frame([c * zero_line for c in rgb])
-            writer.append_data(frame)
-
-
-# TODO: Requires some work. Unstable like this.
-def nucleation_3D(writer, args, R=20):
-    raise NotImplementedError("Needs some work")
+    return model_g, colours_2D
+
+
+def nucleation_3D(args, R=20):
     params = {
         "A": 3.4,
         "B": 13.5,
@@ -178,12 +379,8 @@ def nucleation_3D(writer, args, R=20):
     z = y
     x, y, z = np.meshgrid(x, y, z, indexing='ij')
 
-    def source_G(t):
-        center = np.exp(-0.3*(t-6)**2) * 10
-        return -np.exp(-0.5*(x*x+y*y+z*z)) * center
-
     source_functions = {
-        'G': source_G,
+        'G': Source(-np.exp(-0.5*(x*x+y*y+z*z)), gaussian_pulse(6, 10, rate=0.3)),
     }
 
     # We need some noise to break spherical symmetry
@@ -204,64 +401,93 @@ def nucleation_3D(writer, args, R=20):
         dt=args.dt,
         params=params,
         source_functions=source_functions,
+        dtype=args.dtype,
+        reaction_dtype=args.reaction_dtype,
     )
 
-    flow_particle_origins = []
-    for _ in range(1000):
-        flow_particle_origins.append([np.random.rand() * s for s in x.shape])
-
-    flow_particles = tf.constant(flow_particle_origins, dtype='float64')
-    flow_streaks = 0*x[:,:,0]
+    # Streaks drawn by particles released from fixed points every frame. They are traced through the flow at the end
+    # of the frame rather than the flow of every step in between.
+    tracer = ParticleTracer.random(
+        x.shape, 1000, speed=400, iterations=20 * args.oversampling, deposit=0.15 / args.oversampling
+    )
 
     print("Rendering 'Nucleation and Motion in G gradient in 3D'")
     print("Lattice constant dx = {}, time step dt = {}".format(fluid_model_g.dx, fluid_model_g.dt))
-    for n in progressbar.progressbar(range(args.num_frames)):
-        fluid_model_g.step()
-        for _ in range(20):
-            indices = tf.cast(flow_particles, 'int32')
-            for index in indices.numpy():
-                flow_streaks[index[0], index[1]] += 0.15 / args.oversampling
-            dx = tf.gather_nd(fluid_model_g.u, indices)
-            dy = tf.gather_nd(fluid_model_g.v, indices)
-            dz = tf.gather_nd(fluid_model_g.w, indices)
-            flow_particles = (flow_particles + tf.stack([dx, dy, dz], axis=1) * 400) % x.shape
-        if n % args.oversampling == 0:
-            rgb = [
-                tf.reduce_mean((7*fluid_model_g.G)**2, axis=2) + flow_streaks,
-                tf.reduce_mean((4*fluid_model_g.Y)**2, axis=2),
-                tf.reduce_mean((2*fluid_model_g.X)**2, axis=2),
-            ]
-            frame = make_video_frame(rgb)
-            writer.append_data(frame)
-            flow_streaks *= 0
-            flow_particles = tf.constant(flow_particle_origins, dtype='float64')
+    return fluid_model_g, colours_3D, [tracer]
 
-if __name__ == '__main__':
-    episodes = {
-        'nucleation_and_motion_in_fluid_2D': nucleation_and_motion_in_G_gradient_fluid_2D,
-        'charged_nucleation_in_2D': charged_nucleation_in_2D,
-    }
 
+def colours_3D(fields):
+    return [
+        tf.reduce_mean((7*fields['G'])**2, axis=-1) + fields['streaks'],
+        tf.reduce_mean((4*fields['Y'])**2, axis=-1),
+        tf.reduce_mean((2*fields['X'])**2, axis=-1),
+    ]
+
+
+episodes = {
+    'nucleation_and_motion_in_fluid_2D': nucleation_and_motion_in_G_gradient_fluid_2D,
+    'charged_nucleation_in_2D': charged_nucleation_in_2D,
+    'nucleation_3D': nucleation_3D,
+}
+
+
+def parse_args(argv=None):
+    """
+    Command line arguments (`argv` or those of the process) completed from the parameter file with the derived
+    parameters filled in
+    """
     parser = argparse.ArgumentParser(description='Render audio samples')
     parser.add_argument('outfile', type=str, help='Output file name')
     parser.add_argument('--params', type=str, help='Parameter YAML file name')
     parser.add_argument('--episode', choices=episodes.keys())
     parser.add_argument('--resolution', choices=RESOLUTIONS.keys(), help='Video and simulation grid resolution')
+    parser.add_argument('--sim-resolution', choices=RESOLUTIONS.keys(), help='Simulation grid resolution')
+    parser.add_argument('--video-resolution', choices=RESOLUTIONS.keys(), help='Video resolution. Fields are resampled from the simulation grid')
+    parser.add_argument('--upsampling', choices=['spectral', 'bicubic'], help='Resampling method from the simulation grid to the video')
     parser.add_argument('--width', type=int, help='Video and simulation grid width', metavar='W')
     parser.add_argument('--height', type=int, help='Video and simulation grid height', metavar='H')
     parser.add_argument('--framerate', type=int, help='Video frame rate')
     parser.add_argument('--oversampling', type=int, help='Add extra simulation time steps between video frames for stability')
+    parser.add_argument('--dtype', choices=['float64', 'float32'], help='Precision of the simulation (default float64)')
+    parser.add_argument('--reaction-dtype', choices=['float64', 'float32'], help='Precision of the reaction step (defaults to --dtype)')
     parser.add_argument('--video-quality', type=int, help='Video quality factor')
+    parser.add_argument('--video-writer', choices=['imageio', 'ffmpeg'], help='Encode through imageio or pipe raw frames straight into ffmpeg')
+    parser.add_argument('--preset', type=str, help='ffmpeg encoder preset (ultrafast ... veryslow)')
+    parser.add_argument('--crf', type=int, help='ffmpeg constant rate factor. Lower is better quality')
+    parser.add_argument('--lossless', action='store_true', help='Encode losslessly with ffmpeg')
+    parser.add_argument('--encoder-threads', type=int, help='Number of ffmpeg encoder threads (0 for automatic)', metavar='N')
+    parser.add_argument('--pixel-format', type=str, help='ffmpeg output pixel format')
     parser.add_argument('--video-duration', type=float, help='Duration of video to render in seconds')
     parser.add_argument('--simulation-duration', type=float, help='Amount of simulation to run')
-    args = parser.parse_args()
+    parser.add_argument('--checkpoint-interval', type=int, help='Save the simulation and start a new video segment every N frames', metavar='N')
+    parser.add_argument('--resume', action='store_true', help='Continue an interrupted render from its last checkpoint')
+    parser.add_argument('--pipeline-workers', type=int, help='Number of threads turning simulation fields into video frames', metavar='N')
+    parser.add_argument('--colours', type=str, help='Colour config YAML file (see colour_maps.DEFAULT_COLOURS)')
+    parser.add_argument('--auto-colours', action='store_true', help='Normalise the colour channels by the running quantiles of the fields')
+    parser.add_argument('--colour-ranges', type=str, help='Write the ranges seen during the run and a matching colour config into this YAML file', metavar='FILE')
+    parser.add_argument('--archive', type=str, help='Record the fields of every video frame into this directory', metavar='DIR')
+    parser.add_argument('--archive-flow', action='store_true', help='Record the flow too')
+    parser.add_argument('--archive-chunk', type=int, help='Number of frames per archive chunk', metavar='N')
+    parser.add_argument('--archive-only', action='store_true', help='Only record the fields without writing a video')
+    parser.add_argument('--watchdog-interval', type=int, help='Check the fields for blow-ups every N time steps. Turns the check on for parameter files without a watchdog entry.', metavar='N')
+    parser.add_argument('--rollback', action='store_true', help='Retry with a smaller time step when the simulation blows up instead of aborting. Turns the check on too.')
+    parser.add_argument('--profile', action='store_true', help='Time every phase of the steps and print a summary at the end. The steps run phase by phase and slower.')
+    parser.add_argument('--profile-trace', type=str, help='Write a TensorFlow profiler trace into this directory', metavar='DIR')
+    parser.add_argument('--profile-window', type=int, nargs=2, help='First time step and number of time steps to trace (default 0 10)', metavar=('START', 'STEPS'))
+    args = parser.parse_args(argv)
 
     args.model_params = {}
+    args.watchdog = {}
+    args.outputs = {}
     if args.params:
         with open(args.params) as f:
             params = yaml.load(f, Loader=Loader)
             for key, value in params.items():
-                if not getattr(args, key):
+                # Zero is a valid setting for these so only missing ones are taken from the file
+                if key in ('crf', 'encoder_threads'):
+                    if getattr(args, key) is None:
+                        setattr(args, key, value)
+                elif not getattr(args, key):
                     setattr(args, key, value)
 
     if not args.episode:
@@ -271,12 +497,39 @@ if __name__ == '__main__':
         args.framerate = 24
     if not args.oversampling:
         args.oversampling = 1
+    if not args.dtype:
+        args.dtype = 'float64'
     if not args.video_quality:
         args.video_quality = 10
-
-    writer = imageio.get_writer(args.outfile, fps=args.framerate, quality=args.video_quality, macro_block_size=1)
-
-    # Compute derived parameters
+    if not args.video_writer:
+        args.video_writer = 'imageio'
+    if not args.preset:
+        args.preset = 'medium'
+    if args.crf is None:
+        args.crf = 18
+    if args.encoder_threads is None:
+        args.encoder_threads = 0
+    if not args.pipeline_workers:
+        args.pipeline_workers = 2
+    if not args.archive_chunk:
+        args.archive_chunk = 32
+    if args.archive_only and not args.archive:
+        raise ValueError("Nothing to do without an archive directory")
+    if isinstance(args.colours, str):
+        with open(args.colours) as f:
+            args.colours = yaml.load(f, Loader=Loader)
+    args.watchdog = dict(args.watchdog or {})
+    if args.watchdog_interval:
+        args.watchdog['check_interval'] = args.watchdog_interval
+    if args.rollback:
+        args.watchdog['rollback'] = True
+    if args.resume and not args.checkpoint_interval:
+        raise ValueError("Resuming needs the checkpoint interval the render was started with")
+
+    # Compute derived parameters. The simulation grid follows --sim-resolution, falling back on --resolution or an
+    # explicit width and height. The video is the size of the grid unless --video-resolution says otherwise.
+    if args.sim_resolution:
+        args.width, args.height = RESOLUTIONS[args.sim_resolution]
     if args.resolution:
         width, height = RESOLUTIONS[args.resolution]
         if not args.width:
@@ -285,9 +538,50 @@ if __name__ == '__main__':
             args.height = height
     if (not args.width) or (not args.height):
         raise ValueError("Invalid or missing resolution")
+    if args.video_resolution:
+        args.video_width, args.video_height = RESOLUTIONS[args.video_resolution]
+    else:
+        args.video_width, args.video_height = args.width, args.height
+    if not args.upsampling:
+        args.upsampling = 'spectral'
     args.aspect = args.width / args.height
     args.num_frames = int(args.video_duration * args.oversampling * args.framerate)
     args.dt = args.simulation_duration / args.num_frames
+    return args
+
+
+def main(argv=None, graph_cache=None):
+    """
+    Render a video as the command line (`argv`) says. A `render_daemon.GraphCache` lets the model reuse the
+    integrators compiled for an earlier render.
+    """
+    args = parse_args(argv)
+    model, colours, *probes = episodes[args.episode](args)
+    if graph_cache is not None:
+        graph_cache.adopt(args.episode, model)
+    if args.profile or args.profile_trace:
+        model.profiler = PhaseProfiler(args.profile, args.profile_trace, *(args.profile_window or (0, 10)))
+    probes = probes[0] if probes else []
+    if args.auto_colours:
+        args.colours = auto_colours(args.colours)
+    if args.colours:
+        colours = make_colours(args.colours)
+    outputs = make_outputs(args.outputs, args.outfile, colours, args.colours)
+    if any(output.config and 'speed' in colour_fields(output.config) for output in outputs):
+        probes.append(FlowSpeed())
+    tracked = set(field for output in outputs if output.config for field in ranged_fields(output.config))
+    tracker = RangeTracker(sorted(tracked | set('GXY'))) if args.colour_ranges or tracked else None
+    if tracker:
+        probes.append(tracker)
+    try:
+        render(args, model, outputs, probes)
+    finally:
+        if model.profiler:
+            model.profiler.stop_trace()
+            print(model.profiler.summary())
+    if args.colour_ranges:
+        write_colour_ranges(args.colour_ranges, tracker, args.colours)
 
-    episodes[args.episode](writer, args)
-    writer.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import os
+import queue
+import threading
+from pathlib import Path
+import numpy as np
+
+
+class SnapshotWriter(object):
+    """
+    Writes snapshots of the simulation fields from a background thread
+
+    Submitting a snapshot only queues references to the (immutable) field tensors so the simulation can carry on
+    stepping while a worker copies them out and writes them to disk. The queue is bounded so a slow disk holds
+    the simulation back instead of piling up snapshots in memory.
+
+    Every snapshot goes into its own `snapshot_NNNNNN.npz` file and only the latest `history` of them are kept
+    around (all of them if `history` is 0).
+    """
+
+    def __init__(self, path, compress=False, history=10, max_pending=2):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.compress = compress
+        self.history = history
+        self.written = []
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, index, t, fields):
+        """
+        Queue the fields (a dict of tensors or arrays) at time `t` to be written as snapshot number `index`
+        """
+        self._check()
+        self.queue.put((index, t, dict(fields)))
+
+    def close(self):
+        """
+        Wait for the queued snapshots to be written
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
+    def _check(self):
+        if self.error is not None:
+            raise RuntimeError("Writing a snapshot failed") from self.error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                self._write(*item)
+            except Exception as error:
+                self.error = error
+
+    def _write(self, index, t, fields):
+        arrays = {name: np.asarray(field) for name, field in fields.items()}
+        filename = self.path / 'snapshot_{:06d}.npz'.format(index)
+        temporary = self.path / 'snapshot_{:06d}.npz.tmp'.format(index)
+        save = np.savez_compressed if self.compress else np.savez
+        with open(temporary, 'wb') as f:
+            save(f, t=t, **arrays)
+        os.replace(temporary, filename)
+
+        self.written.append(filename)
+        while self.history and len(self.written) > self.history:
+            os.remove(self.written.pop(0))
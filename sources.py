@@ -0,0 +1,70 @@
+import numpy as np
+import tensorflow as tf
+
+
+class Source(object):
+    """
+    Source term that separates into fixed spatial profiles scaled by scalar time envelopes
+
+    The profiles are converted into tensors once when the source is declared. Only the envelopes are evaluated
+    inside the step graph so nothing has to be recomputed on the grid or copied over from the host during a run.
+    Sources with several terms are built by adding single term sources together.
+
+    Envelopes are probed every step and a term whose contribution would fall below the tolerance is skipped
+    without touching the grid. It is picked up again as soon as its envelope rises back above it.
+    """
+
+    def __init__(self, profile, envelope=None):
+        """
+        `profile` is an array over the simulation grid and `envelope` a function of the (tensor) time `t` written
+        in terms of TensorFlow ops. A missing envelope means the source is constant in time.
+        """
+        self.terms = [(tf.constant(profile, 'float64'), envelope, float(np.abs(profile).max()))]
+
+    def __add__(self, other):
+        result = Source.__new__(Source)
+        result.terms = self.terms + other.terms
+        return result
+
+    def __call__(self, t):
+        result = 0
+        for profile, envelope, _ in self.terms:
+            if envelope is None:
+                result += profile
+            else:
+                result += envelope(t) * profile
+        return result
+
+    def apply(self, t, field, scale, tolerance=0):
+        """
+        Add `scale` times the source at time `t` to `field` leaving out terms that change it by at most `tolerance`.
+        The source is added at the precision of `field`.
+        """
+        for profile, envelope, peak in self.terms:
+            profile = tf.cast(profile, field.dtype)
+            if envelope is None:
+                field += scale * profile
+                continue
+            amount = scale * envelope(t)
+            significant = tf.abs(amount) * peak > tolerance
+            amount = tf.cast(amount, field.dtype)
+            field = tf.cond(
+                significant,
+                lambda field=field, amount=amount, profile=profile: field + amount * profile,
+                lambda field=field: field
+            )
+        return field
+
+
+def gaussian_pulse(t0, amplitude=1.0, rate=0.5):
+    """
+    Time envelope amplitude * exp(-rate * (t - t0)**2)
+    """
+    return lambda t: amplitude * tf.exp(-rate * (t - t0)**2)
+
+
+def tanh_switch(t0, amplitude=1.0):
+    """
+    Time envelope that switches on smoothly from 0 to 2 * amplitude around t0
+    """
+    return lambda t: amplitude * (1 + tf.tanh(t - t0))
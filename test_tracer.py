@@ -0,0 +1,55 @@
+import numpy as np
+import tensorflow as tf
+
+import render_video
+from pde_solver import Watchdog
+from tracer import ParticleTracer
+
+
+def uniform_flow(shape, velocity):
+    return {name: tf.fill(shape, tf.constant(component, 'float64')) for name, component in zip('uvw', velocity)}
+
+
+def test_uniform_flow_moves_particles_by_a_known_offset():
+    shape = (16, 12, 8)
+    # One cell along x and two along y per iteration. The second particle wraps around the grid.
+    tracer = ParticleTracer(shape, [[2.5, 3.5, 1.5], [15.5, 11.5, 6.5]], speed=100, iterations=3, deposit=1.0)
+    streaks = tracer.update(uniform_flow(shape, (0.01, 0.02, 0.0)))['streaks'].numpy()
+
+    np.testing.assert_allclose(tracer.positions.numpy(), [[5.5, 9.5, 1.5], [2.5, 5.5, 6.5]])
+    expected = np.zeros(shape[:2])
+    for x, y in [(2, 3), (3, 5), (4, 7), (15, 11), (0, 1), (1, 3)]:
+        expected[x, y] = 1
+    np.testing.assert_array_equal(streaks, expected)
+
+
+def test_streaks_start_over_unless_persistent():
+    shape = (8, 8, 8)
+    flow = uniform_flow(shape, (0.0, 0.0, 0.01))
+    for persistent, deposit in ((False, 2.0), (True, 4.0)):
+        tracer = ParticleTracer(shape, [[1.5, 1.5, 1.5]], speed=100, iterations=2, deposit=1.0, persistent=persistent)
+        tracer.update(flow)
+        streaks = tracer.update(flow)['streaks'].numpy()
+        assert streaks[1, 1] == deposit
+        assert streaks.sum() == deposit
+
+
+def test_nucleation_3D_stays_finite_under_the_watchdog():
+    np.random.seed(0)
+    # A coarse grid through the source pulse. It needs dt = 0.125 to stay stable at this dx.
+    args = render_video.parse_args([
+        'unused.mp4', '--episode', 'nucleation_3D', '--width', '32', '--height', '24', '--framerate', '12',
+        '--oversampling', '8', '--video-duration', '1', '--simulation-duration', '12', '--watchdog-interval', '5',
+    ])
+    model, colours, probes = render_video.episodes[args.episode](args)
+    model.watchdog = Watchdog(**args.watchdog)
+    for _ in range(args.num_frames // args.oversampling):
+        model.advance(args.oversampling)
+        fields = model.fields()
+        for probe in probes:
+            fields.update(probe.update(fields))
+    # The source pulse has been and gone
+    assert model.t > 11
+    for name, field in fields.items():
+        assert np.isfinite(field.numpy()).all(), name
+    assert all(np.isfinite(channel.numpy()).all() for channel in colours(fields))
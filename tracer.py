@@ -0,0 +1,90 @@
+import itertools
+import numpy as np
+import tensorflow as tf
+
+
+class ParticleTracer(object):
+    """
+    Flow particles advected through the velocity field that leave streaks behind
+
+    Positions are in grid units and stay on the device. Every sub-iteration the velocity is interpolated trilinearly
+    (bilinearly in 2D) at all particles at once from the periodic grid, the particles move `speed` times that far and
+    `deposit` is added to the streak image under each of them with a single scatter. The streak image is the
+    projection of the grid along its last axis in 3D and the grid itself in 2D.
+
+    Used as a render probe: `update(fields)` traces `iterations` sub-iterations through the flow components u, v(, w)
+    and returns the streaks as an extra field. Unless `persistent` the particles start over from their origins and
+    the streaks are cleared on every update.
+    """
+
+    def __init__(self, shape, origins, speed=400.0, iterations=20, deposit=0.15, persistent=False):
+        self.shape = tuple(shape)
+        self.dims = len(self.shape)
+        self.origins = tf.constant(origins, 'float64')
+        self.speed = speed
+        self.iterations = iterations
+        self.deposit = deposit
+        self.persistent = persistent
+        self.image_shape = self.shape[:2]
+        self.reset()
+        self.trace = tf.function(self._trace, jit_compile=True)
+
+    @classmethod
+    def random(cls, shape, count, **kwargs):
+        """
+        Tracer with `count` particles starting from uniformly random positions
+        """
+        return cls(shape, np.random.rand(count, len(shape)) * shape, **kwargs)
+
+    def reset(self):
+        self.positions = self.origins
+        self.streaks = tf.zeros(self.image_shape, 'float64')
+
+    def checkpoint_state(self):
+        """
+        Origins, positions and streaks as arrays for a checkpoint
+        """
+        return {'origins': self.origins.numpy(), 'positions': self.positions.numpy(), 'streaks': self.streaks.numpy()}
+
+    def restore_state(self, state):
+        """
+        Carry on from the particles stored by `checkpoint_state`. The origins may have been drawn at random.
+        """
+        self.origins = tf.constant(state['origins'], 'float64')
+        self.positions = tf.constant(state['positions'], 'float64')
+        self.streaks = tf.constant(state['streaks'], 'float64')
+
+    def interpolate(self, velocity, positions):
+        """
+        Interpolate the stacked `velocity` components (grid shape + [dims]) at `positions` ([count, dims])
+        """
+        base = tf.floor(positions)
+        fraction = positions - base
+        base = tf.cast(base, 'int32')
+        shape = tf.constant(self.shape, 'int32')
+        result = 0
+        for corner in itertools.product((0, 1), repeat=self.dims):
+            weight = tf.reduce_prod(tf.where([c == 1 for c in corner], fraction, 1 - fraction), axis=1, keepdims=True)
+            result += weight * tf.gather_nd(velocity, (base + corner) % shape)
+        return result
+
+    def _trace(self, positions, streaks, velocity):
+        period = tf.constant(self.shape, 'float64')
+        image_shape = tf.constant(self.image_shape, 'int32')
+        amount = tf.fill(tf.shape(positions)[:1], tf.constant(self.deposit, 'float64'))
+
+        def body(i, positions, streaks):
+            pixels = tf.cast(tf.floor(positions[:, :2]), 'int32') % image_shape
+            streaks = tf.tensor_scatter_nd_add(streaks, pixels, amount)
+            positions = (positions + self.interpolate(velocity, positions) * self.speed) % period
+            return i + 1, positions, streaks
+        _, positions, streaks = tf.while_loop(lambda i, *_: i < self.iterations, body, (0, positions, streaks))
+        return positions, streaks
+
+    def update(self, fields):
+        if not self.persistent:
+            self.reset()
+        # Particles are traced in float64 whatever the precision of the flow
+        velocity = tf.stack([fields[name] for name in 'uvw'[:self.dims]], axis=-1)
+        self.positions, self.streaks = self.trace(self.positions, self.streaks, tf.cast(velocity, 'float64'))
+        return {'streaks': tf.cast(self.streaks, velocity.dtype)}
@@ -0,0 +1,77 @@
+import tensorflow as tf
+
+
+class Upsampler(object):
+    """
+    Resample 2D fields from the simulation grid to the video frame size
+
+    `spectral` zero-pads (or truncates) the spectrum of the periodic fields, which is exact for the band-limited
+    fields a spectral solver produces. `bicubic` interpolates in real space instead. Shapes are given in 'ij'
+    indexing as (width, height) and any leading axes of the fields are kept.
+    """
+
+    def __init__(self, shape, target_shape, method='spectral'):
+        if method not in ('spectral', 'bicubic'):
+            raise ValueError("Unknown upsampling method {}".format(method))
+        self.shape = tuple(shape)
+        self.target_shape = tuple(target_shape)
+        self.method = method
+
+    def __call__(self, field):
+        if self.method == 'spectral':
+            return self.spectral(field)
+        return self.bicubic(field)
+
+    def spectral(self, field):
+        width, height = self.shape
+        target_width, target_height = self.target_shape
+        f = tf.signal.rfft2d(tf.cast(field, 'float64'))
+
+        # On an even number of modes the Nyquist coefficient stands for both +Nyquist and -Nyquist. When upsampling
+        # it is split in half between the two. When downsampling the two modes of the finer grid that land on the
+        # new Nyquist are added together.
+
+        # First axis holds the full spectrum with the negative frequencies at the end
+        n = min(width, target_width)
+        if width != target_width:
+            positive, negative = f[..., :(n + 1) // 2, :], f[..., width - (n - 1) // 2:, :]
+            zeros = lambda count: tf.zeros(tf.concat([tf.shape(f)[:-2], [count, tf.shape(f)[-1]]], axis=0), f.dtype)
+            if n % 2:
+                middle = [zeros(target_width - n)]
+            elif width < target_width:
+                nyquist = f[..., n // 2:n // 2 + 1, :] / 2
+                middle = [nyquist, zeros(target_width - n - 1), nyquist]
+            else:
+                middle = [f[..., n // 2:n // 2 + 1, :] + f[..., width - n // 2:width - n // 2 + 1, :]]
+            f = tf.concat([positive] + middle + [negative], axis=-2)
+
+        # Last axis only holds the non-negative half. The negative one is the complex conjugate at the negated
+        # frequencies of the first axis.
+        n = min(height, target_height)
+        if height != target_height:
+            zeros = tf.zeros(tf.concat([tf.shape(f)[:-1], [target_height // 2 + 1 - (n // 2 + 1)]], axis=0), f.dtype)
+            last = f[..., n // 2:n // 2 + 1]
+            if n % 2 == 0 and height < target_height:
+                last /= 2
+            elif n % 2 == 0:
+                last += tf.math.conj(tf.roll(tf.reverse(last, axis=[-2]), 1, axis=-2))
+            f = tf.concat([f[..., :n // 2], last, zeros], axis=-1)
+
+        scale = target_width * target_height / (width * height)
+        return tf.signal.irfft2d(f, fft_length=[target_width, target_height]) * scale
+
+    def bicubic(self, field):
+        field = tf.cast(field, 'float32')
+        leading = tf.shape(field)[:-2]
+        images = tf.reshape(field, tf.concat([[-1], self.shape, [1]], axis=0))
+        images = tf.image.resize(images, self.target_shape, method='bicubic')
+        return tf.reshape(images, tf.concat([leading, self.target_shape], axis=0))
+
+    def fields(self, fields):
+        """
+        Upsample the fields on the simulation grid leaving everything else (such as tracked ranges) as it is
+        """
+        return {
+            name: self(field) if tuple(field.shape[-2:]) == self.shape else field
+            for name, field in fields.items()
+        }
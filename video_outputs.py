@@ -0,0 +1,124 @@
+import os
+import tensorflow as tf
+
+from colour_maps import field_colours, make_colours
+
+
+PROJECTIONS = {
+    'mean': tf.reduce_mean,
+    'max': tf.reduce_max,
+    'sum': tf.reduce_sum,
+}
+
+
+class VideoOutput(object):
+    """
+    One of the videos rendered from a run
+
+    Before `colours` maps them to channels the fields on the simulation grid can be cut down to the `slice` at an
+    index along `axis` (the middle for a slice of 'middle') or projected along it with `projection` ('mean', 'max' or
+    'sum'). 3D runs need one or the other unless `colours` projects by itself like the episode colours do.
+    `config` is the colour config behind `colours` if there is one.
+    """
+
+    def __init__(self, filename, colours, config=None, slice=None, projection=None, axis=-1):
+        if slice is not None and projection is not None:
+            raise ValueError("Output {} has both a slice and a projection".format(filename))
+        if projection is not None and projection not in PROJECTIONS:
+            raise ValueError("Unknown projection {}".format(projection))
+        self.filename = filename
+        self.colours = colours
+        self.config = config
+        self.slice = slice
+        self.projection = projection
+        self.axis = axis
+
+    def view(self, fields, dims):
+        """
+        `fields` with the grid fields sliced or projected. Leading axes such as the frames of an archive chunk are kept.
+        """
+        if self.slice is None and self.projection is None:
+            return fields
+        if dims < 3:
+            raise ValueError("Slices and projections of {} need a 3D episode".format(self.filename))
+        axis = self.axis - dims if self.axis >= 0 else self.axis
+        result = {}
+        for name, field in fields.items():
+            if len(field.shape) >= dims:
+                if self.projection is not None:
+                    field = PROJECTIONS[self.projection](field, axis=axis)
+                else:
+                    index = field.shape[axis] // 2 if self.slice == 'middle' else self.slice
+                    field = tf.gather(field, index, axis=axis)
+            result[name] = field
+        return result
+
+
+def make_outputs(config, outfile, colours, colour_config=None):
+    """
+    The outputs declared by the `outputs` entry of a parameter file. Each named entry may set
+
+        outfile: File name. Defaults to `outfile` with the name of the output appended.
+        field: Show just this field in greyscale, optionally with `min`, `max`, `gain` and `invert` (see
+            `colour_maps.field_colours`). The ranges default to 'auto'. `speed` is the flow speed.
+        colours: Colour config (see `colour_maps.DEFAULT_COLOURS`)
+        slice, projection, axis: See `VideoOutput`
+
+    Entries without a field or colours are drawn in `colours` (made from `colour_config`). Without any entries the
+    only output is `outfile` itself.
+    """
+    if not config:
+        return [VideoOutput(outfile, colours, colour_config)]
+
+    root, ext = os.path.splitext(outfile)
+    outputs = []
+    for name, settings in config.items():
+        settings = dict(settings or {})
+        filename = settings.pop('outfile', '{}_{}{}'.format(root, name, ext))
+        view = {key: settings.pop(key) for key in ('slice', 'projection', 'axis') if key in settings}
+        if 'field' in settings:
+            channel = {key: settings.pop(key) for key in ('field', 'min', 'max', 'gain', 'invert') if key in settings}
+            output_config = field_colours(**channel)
+            output_colours = make_colours(output_config)
+        elif 'colours' in settings:
+            output_config = settings.pop('colours')
+            output_colours = make_colours(output_config)
+        else:
+            output_config, output_colours = colour_config, colours
+        if settings:
+            raise ValueError("Unknown settings {} for output {}".format(', '.join(settings), name))
+        outputs.append(VideoOutput(filename, output_colours, output_config, **view))
+    return outputs
+
+
+class FlowSpeed(object):
+    """
+    Render probe adding the magnitude of the flow as the field `speed`
+    """
+
+    def update(self, fields):
+        flow = [fields[name] for name in 'uvw' if name in fields]
+        return {'speed': tf.sqrt(sum(component**2 for component in flow))}
+
+
+class MultiWriter(object):
+    """
+    Video writers fed in lockstep. Every frame is a list with a frame for each writer.
+    """
+
+    def __init__(self, writers):
+        self.writers = writers
+
+    def append_data(self, frames):
+        for writer, frame in zip(self.writers, frames):
+            writer.append_data(frame)
+
+    def close(self):
+        errors = []
+        for writer in self.writers:
+            try:
+                writer.close()
+            except Exception as error:
+                errors.append(error)
+        if errors:
+            raise errors[0]